@@ -1,4 +1,6 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started
 import logging
 
 logger = logging.getLogger(__name__)
@@ -12,10 +14,27 @@ class ErpToolsConfig(AppConfig):
         # Регистрируем signals
         import erp_tools.signals
         
-        # Запускаем consumer при старте приложения
-        try:
-            from erp_tools.kafka_service import KafkaService
-            KafkaService.start_consumer()
-            logger.info("Kafka consumer started successfully")
-        except Exception as e:
-            logger.warning(f"Failed to start Kafka consumer: {e}. Kafka integration may not work.")
\ No newline at end of file
+        # Consumer в процессе веб-сервера запускается только по явной настройке,
+        # штатно он работает отдельно: python manage.py run_kafka_consumer
+        if not settings.KAFKA_CONSUMER_IN_WEB_PROCESS:
+            return
+        
+        # Поток consumer-а запускается при первом запросе в каждом рабочем процессе,
+        # а не здесь: при предзагрузке приложения (gunicorn --preload, автоперезагрузка
+        # runserver) ready() выполняется в родительском процессе, потоки которого
+        # не переживают fork
+        request_started.connect(start_consumer_in_worker, dispatch_uid=CONSUMER_DISPATCH_UID)
+
+
+CONSUMER_DISPATCH_UID = 'erp_tools.start_consumer_in_worker'
+
+
+def start_consumer_in_worker(sender, **kwargs):
+    """Запустить consumer в текущем процессе веб-сервера при первом запросе"""
+    request_started.disconnect(dispatch_uid=CONSUMER_DISPATCH_UID)
+    try:
+        from erp_tools.kafka_service import KafkaService
+        KafkaService.start_consumer()
+        logger.info("Kafka consumer started successfully")
+    except Exception as e:
+        logger.warning(f"Failed to start Kafka consumer: {e}. Kafka integration may not work.")
@@ -0,0 +1,67 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для вызовов внешней системы (брокера Kafka).
+
+    После failure_threshold ошибок подряд цепь размыкается, и allow_request()
+    возвращает False без обращения к системе. Раз в reset_timeout секунд
+    пропускается один пробный вызов: успех замыкает цепь, ошибка снова
+    размыкает ее на reset_timeout. Если результат пробы так и не сообщен,
+    следующая проба разрешается через тот же интервал.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow_request(self) -> bool:
+        """Можно ли обращаться к системе; при разомкнутой цепи раз в reset_timeout пропускает пробный вызов"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._opened_at = now
+                logger.info(f"Circuit '{self.name}' half-open, probing")
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info(f"Circuit '{self.name}' closed")
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(
+                        f"Circuit '{self.name}' opened after {self._failures} failures, "
+                        f"retry in {self.reset_timeout}s"
+                    )
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
@@ -0,0 +1,330 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from django.db import connections
+from kafka import ConsumerRebalanceListener
+from kafka.structs import TopicPartition
+
+logger = logging.getLogger(__name__)
+
+# Сигнал завершения рабочего потока
+_STOP = object()
+
+
+class OffsetTracker:
+    """
+    Учет обработанных offset-ов по партициям при параллельной обработке.
+
+    Offset-ы регистрируются в порядке чтения (add) и отмечаются обработанными
+    в любом порядке (done). Фиксировать можно только offset, следующий за
+    непрерывной последовательностью обработанных сообщений: если сообщение 5
+    еще обрабатывается, а 6 и 7 готовы, фиксируется 5.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[TopicPartition, deque] = {}
+        self._done: Dict[TopicPartition, set] = {}
+        self._committable: Dict[TopicPartition, int] = {}
+
+    def add(self, tp: TopicPartition, offset: int):
+        with self._lock:
+            self._pending.setdefault(tp, deque()).append(offset)
+
+    def done(self, tp: TopicPartition, offset: int):
+        with self._lock:
+            pending = self._pending.get(tp)
+            if pending is None:
+                # Партиция отозвана при ребалансировке
+                return
+            done = self._done.setdefault(tp, set())
+            done.add(offset)
+            while pending and pending[0] in done:
+                done.discard(pending[0])
+                self._committable[tp] = pending.popleft() + 1
+
+    def pop_committable(self) -> Dict[TopicPartition, int]:
+        """Offset-ы для фиксации (следующее сообщение к чтению), накопленные с прошлого вызова"""
+        with self._lock:
+            committable, self._committable = self._committable, {}
+            return committable
+
+    def forget(self, partitions: Iterable[TopicPartition]):
+        """Забыть отозванные партиции"""
+        with self._lock:
+            for tp in partitions:
+                self._pending.pop(tp, None)
+                self._done.pop(tp, None)
+                self._committable.pop(tp, None)
+
+
+class KeyedDispatcher:
+    """
+    Пул рабочих потоков с распределением сообщений по ключу.
+
+    Сообщения с одинаковым ключом (заявка) попадают в один поток и
+    обрабатываются в порядке поступления; сообщения разных заявок
+    обрабатываются параллельно. Поток забирает из своей очереди до batch_size
+    сообщений и передает их в handler одной пачкой. handler возвращает
+    сообщения, обработка которых завершена: отложенные для повтора в их число
+    не входят и возвращаются позже, когда будут переданы снова (resubmit) и
+    обработаны. Очереди ограничены queue_size: при отставании потоков submit()
+    блокирует чтение из Kafka.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        handler: Callable[[List[Any]], List[Any]],
+        queue_size: int,
+        batch_size: int,
+        tracker: Optional[OffsetTracker] = None,
+    ):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.tracker = tracker or OffsetTracker()
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._work, args=(q,), name=f'kafka-dispatch-{index}', daemon=True)
+            for index, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key: Any, record: Any):
+        """Передать сообщение в поток, отвечающий за key"""
+        self.tracker.add(TopicPartition(record.topic, record.partition), record.offset)
+        self.resubmit(key, record)
+
+    def resubmit(self, key: Any, record: Any):
+        """Повторно передать уже учтенное сообщение (повтор после ошибки)"""
+        slot = zlib.crc32(str(key).encode('utf-8')) % len(self._queues)
+        self._queues[slot].put(record)
+
+    def skip(self, record: Any):
+        """Учесть сообщение, которое не требует обработки (собственное, нечитаемое)"""
+        tp = TopicPartition(record.topic, record.partition)
+        self.tracker.add(tp, record.offset)
+        self.tracker.done(tp, record.offset)
+
+    def wait_idle(self):
+        """Дождаться обработки всех переданных сообщений"""
+        for q in self._queues:
+            q.join()
+
+    def stop(self):
+        """Обработать оставшиеся сообщения и остановить потоки"""
+        self.wait_idle()
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self, q: queue.Queue):
+        try:
+            while True:
+                item = q.get()
+                if item is _STOP:
+                    q.task_done()
+                    return
+                batch = [item]
+                stop = False
+                while len(batch) < self.batch_size:
+                    try:
+                        item = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+
+                finished = batch
+                try:
+                    finished = self.handler(batch)
+                except Exception as e:
+                    logger.error(f"Error in consumer worker thread: {e}", exc_info=True)
+                finally:
+                    for record in finished:
+                        self.tracker.done(TopicPartition(record.topic, record.partition), record.offset)
+                    for _ in batch:
+                        q.task_done()
+
+                if stop:
+                    q.task_done()
+                    return
+        finally:
+            # У каждого потока свое соединение с БД
+            connections.close_all()
+
+
+class RetryScheduler:
+    """
+    Очередь отложенных повторов сообщений с экспоненциальной задержкой.
+
+    Сообщение ждет в памяти (куча по времени повтора), цикл чтения не
+    блокируется: pop_due() отдает сообщения, время повтора которых наступило.
+    Задержка после n-й неудачи - base_delay * 2^(n-1), но не больше
+    max_delay. Offset отложенного сообщения не фиксируется (OffsetTracker),
+    поэтому при падении процесса оно будет прочитано снова.
+
+    Сообщение, отложенное с ключом упорядочивания, задерживает следующие
+    сообщения с тем же ключом: admit() ставит их в цепочку за ним. pop_due()
+    отдает только первое сообщение цепочки; когда оно снова передается в
+    admit(), цепочка снимается и возвращается целиком, по порядку.
+    """
+
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        # (время повтора, порядковый номер, ключ, цепочка: отложенное сообщение и ждущие за ним)
+        self._heap = []
+        self._sequence = itertools.count()
+        # Ключ упорядочивания -> цепочка; остается до admit() первого сообщения
+        self._chains: Dict[Any, list] = {}
+        # (topic, partition, offset) -> [количество неудачных попыток, последняя ошибка]
+        self._failures: Dict[tuple, list] = {}
+
+    @staticmethod
+    def _record_id(record) -> tuple:
+        return record.topic, record.partition, record.offset
+
+    def attempts(self, record) -> int:
+        """Количество неудачных попыток обработки сообщения"""
+        with self._lock:
+            return self._failures.get(self._record_id(record), [0])[0]
+
+    def last_error(self, record) -> Optional[Exception]:
+        """Ошибка последней неудачной попытки"""
+        with self._lock:
+            return self._failures.get(self._record_id(record), [0, None])[1]
+
+    def schedule(self, record, error: Exception, force: bool = False, key: Any = None) -> bool:
+        """
+        Учесть неудачную попытку и отложить сообщение.
+
+        Возвращает False, если попытки исчерпаны (сообщение нужно отправить в
+        DLQ). force - отложить на max_delay без учета лимита попыток. key -
+        ключ упорядочивания: до повтора admit() задерживает сообщения с этим ключом.
+        """
+        with self._lock:
+            failure = self._failures.setdefault(self._record_id(record), [0, None])
+            failure[0] += 1
+            failure[1] = error
+            if force:
+                delay = self.max_delay
+            elif failure[0] > self.max_attempts:
+                return False
+            else:
+                delay = min(self.base_delay * 2 ** (failure[0] - 1), self.max_delay)
+            chain = [record]
+            if key is not None:
+                self._chains[key] = chain
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), key, chain))
+            return True
+
+    def admit(self, key: Any, record) -> List[Any]:
+        """
+        Сообщения, которые можно обрабатывать вместо record.
+
+        Пустой список - у ключа есть отложенное сообщение, record встает в
+        очередь за ним. Для первого сообщения цепочки (повтор из pop_due)
+        возвращается вся цепочка. Иначе - сам record.
+        """
+        if key is None:
+            return [record]
+        with self._lock:
+            chain = self._chains.get(key)
+            if chain is None:
+                return [record]
+            if self._record_id(chain[0]) == self._record_id(record):
+                del self._chains[key]
+                return chain
+            chain.append(record)
+            return []
+
+    def pop_due(self) -> List[Any]:
+        """Отложенные сообщения, время повтора которых наступило (без ждущих за ними)"""
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[3][0])
+        return due
+
+    def discard(self, record):
+        """Забыть неудачные попытки обработанного сообщения"""
+        if not self._failures:
+            return
+        with self._lock:
+            self._failures.pop(self._record_id(record), None)
+
+    def forget(self, partitions: Iterable[TopicPartition]):
+        """Отбросить отложенные сообщения отозванных партиций: их прочитает новый владелец"""
+        revoked = {(tp.topic, tp.partition) for tp in partitions}
+        now = time.monotonic()
+        with self._lock:
+            heap = []
+            for due, sequence, key, chain in self._heap:
+                head = chain[0]
+                chain[:] = [record for record in chain if (record.topic, record.partition) not in revoked]
+                if chain:
+                    # Ждущие сообщения других партиций больше не ждут отозванное
+                    heap.append((due if chain[0] is head else now, sequence, key, chain))
+                elif key is not None:
+                    del self._chains[key]
+            self._heap = heap
+            heapq.heapify(self._heap)
+            self._failures = {
+                record_id: failure
+                for record_id, failure in self._failures.items()
+                if record_id[:2] not in revoked
+            }
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entry[3]) for entry in self._heap)
+
+
+class DrainOnRevokeListener(ConsumerRebalanceListener):
+    """
+    Перед отзывом партиций дождаться обработки переданных сообщений и
+    зафиксировать offset-ы, чтобы новый владелец партиции начал с первого
+    необработанного сообщения. Отложенные повторы отозванных партиций
+    отбрасываются: их offset-ы не зафиксированы.
+    """
+
+    def __init__(
+        self,
+        tracker: OffsetTracker,
+        commit: Callable[[], None],
+        dispatcher: Optional[KeyedDispatcher] = None,
+        retries: Optional[RetryScheduler] = None,
+    ):
+        self.tracker = tracker
+        self.commit = commit
+        self.dispatcher = dispatcher
+        self.retries = retries
+
+    def on_partitions_revoked(self, revoked):
+        if self.dispatcher is not None:
+            self.dispatcher.wait_idle()
+        try:
+            self.commit()
+        except Exception as e:
+            logger.warning(f"Failed to commit offsets before rebalance: {e}")
+        self.tracker.forget(revoked)
+        if self.retries is not None:
+            self.retries.forget(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        pass
@@ -0,0 +1,109 @@
+import datetime
+import json
+import uuid
+from decimal import Decimal
+from typing import Any
+
+from django.conf import settings
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_default(value: Any) -> Any:
+    """
+    Преобразование типов, которых нет в JSON.
+
+    datetime/date/time - ISO 8601, Decimal (поля sla_*/time_*) - строка без потери
+    точности, UUID - строка. Используется обоими кодеками и энкодером JSONField.
+    """
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (Decimal, uuid.UUID)):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class StdlibCodec:
+    """Кодек на стандартном модуле json"""
+
+    name = 'json'
+
+    @staticmethod
+    def dumps(value: Any) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=encode_default).encode('utf-8')
+
+    @staticmethod
+    def loads(data) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """
+    Кодек на orjson: datetime и UUID кодируются нативно, Decimal - через encode_default.
+
+    orjson.JSONDecodeError наследуется от json.JSONDecodeError, поэтому
+    обработчики ошибок разбора не зависят от кодека.
+    """
+
+    name = 'orjson'
+
+    @staticmethod
+    def dumps(value: Any) -> bytes:
+        return orjson.dumps(value, default=encode_default, option=orjson.OPT_NON_STR_KEYS)
+
+    @staticmethod
+    def loads(data) -> Any:
+        return orjson.loads(data)
+
+
+CODECS = {codec.name: codec for codec in (StdlibCodec, OrjsonCodec)}
+
+
+def get_codec(name: str):
+    """Кодек по имени JSON_CODEC; 'auto' - orjson, если он установлен, иначе json"""
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in CODECS:
+        raise ValueError(f"Unknown JSON_CODEC: {name}")
+    if name == 'orjson' and orjson is None:
+        raise ValueError("JSON_CODEC is 'orjson', but orjson is not installed")
+    return CODECS[name]
+
+
+codec = get_codec(settings.JSON_CODEC)
+
+
+def dumps(value: Any) -> bytes:
+    """Закодировать значение в JSON (UTF-8)"""
+    return codec.dumps(value)
+
+
+def loads(data) -> Any:
+    """Разобрать JSON из bytes или str"""
+    return codec.loads(data)
+
+
+class CodecJSONEncoder(json.JSONEncoder):
+    """Энкодер для JSONField с теми же правилами преобразования типов, что у кодека"""
+
+    def default(self, o):
+        try:
+            return encode_default(o)
+        except TypeError:
+            return super().default(o)
+
+
+class JsonResponse(HttpResponse):
+    """Аналог django.http.JsonResponse, кодирующий данные через JSON_CODEC"""
+
+    def __init__(self, data, safe: bool = True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError(
+                "In order to allow non-dict objects to be serialized set the safe parameter to False."
+            )
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
@@ -1,17 +1,41 @@
-import json
 import logging
-from typing import Dict, Any, Optional
-from datetime import datetime
+import os
+import socket
+from typing import Dict, Any, Callable, Iterable, List, Optional, Tuple
+from datetime import datetime, timedelta
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.dateparse import parse_datetime
-from kafka import KafkaProducer, KafkaConsumer
-from kafka.errors import KafkaError
+from kafka import KafkaProducer, KafkaConsumer, codec
+from kafka.structs import OffsetAndMetadata, TopicPartition
+from erp_tools import json_codec, metrics
+from erp_tools.circuit_breaker import CircuitBreaker
+from erp_tools.consumer_dispatch import DrainOnRevokeListener, KeyedDispatcher, OffsetTracker, RetryScheduler
+from erp_tools.reference_cache import reference_cache
+from erp_tools.serializers import serialize_issue
+from erp_tools.spool import DiskSpool
+from pathlib import Path
 import threading
+import time
 import atexit
+import functools
+from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
 
+class Unprocessable1CMessage(Exception):
+    """Сообщение от 1С, которое не будет обработано и при повторе (нечитаемое, неизвестный тип): сразу в DLQ"""
+
+
+@functools.lru_cache(maxsize=None)
+def decoded_record_type(record_type):
+    """Тип сообщения consumer-а (namedtuple) с декодированным value и полем raw_value - исходными байтами для DLQ"""
+    return namedtuple(f"Decoded{record_type.__name__}", record_type._fields + ('raw_value',))
+
+
 class KafkaService:
     """Сервис для работы с Kafka 3.7.0"""
     
@@ -20,9 +44,31 @@ class KafkaService:
     _consumer_thread: Optional[threading.Thread] = None
     _running = False
     
+    # Предохранитель producer-а: при недоступном брокере вызовы не выполняются,
+    # а события прямой отправки складываются в локальный буфер _spool
+    _circuit = CircuitBreaker(
+        'kafka-producer',
+        failure_threshold=settings.KAFKA_CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=settings.KAFKA_CIRCUIT_RESET_TIMEOUT,
+    )
+    _spool: Optional[DiskSpool] = None
+    _spool_lock = threading.Lock()
+    _spool_thread: Optional[threading.Thread] = None
+    # Процесс, которому принадлежат клиенты Kafka (см. _reset_after_fork)
+    _pid = os.getpid()
+    
+    # Заголовок источника: consumer отбрасывает собственные сообщения, не декодируя их
+    SOURCE_HEADER = 'source'
+    SOURCE_DJANGO = b'django'
+    SOURCE_HEADERS = [(SOURCE_HEADER, SOURCE_DJANGO)]
+    # Строка outbox без события: relay_outbox отправляет по ней только состояние заявки
+    STATE_EVENT = 'state'
+    
     @classmethod
     def get_producer(cls) -> KafkaProducer:
-        """Получить или создать Kafka Producer"""
+        """Получить или создать Kafka Producer текущего процесса"""
+        if cls._pid != os.getpid():
+            cls._reset_after_fork()
         if cls._producer is None:
             try:
                 bootstrap_servers = settings.KAFKA_BOOTSTRAP_SERVERS.split(',')
@@ -30,69 +76,707 @@ class KafkaService:
                 # Базовая конфигурация Producer
                 producer_config = {
                     'bootstrap_servers': bootstrap_servers,
-                    'value_serializer': lambda v: json.dumps(v, ensure_ascii=False, default=str).encode('utf-8'),
+                    'value_serializer': cls._serialize_value,
                     'key_serializer': lambda k: str(k).encode('utf-8') if k else None,
-                    'acks': 'all',
-                    'retries': 3,
-                    'max_in_flight_requests_per_connection': 1,
+                    # Ограничивают ожидание брокера при создании producer-а и в send();
+                    # bootstrap_timeout_ms есть в kafka-python начиная с 3.0
+                    'bootstrap_timeout_ms': settings.KAFKA_PRODUCER_MAX_BLOCK_MS,
+                    'max_block_ms': settings.KAFKA_PRODUCER_MAX_BLOCK_MS,
+                    **cls._producer_profile_config(settings.KAFKA_PRODUCER_PROFILE),
                 }
                 
                 cls._producer = KafkaProducer(**producer_config)
-                logger.info(f"Kafka Producer initialized with servers: {bootstrap_servers}")
+                logger.info(
+                    f"Kafka Producer initialized with servers: {bootstrap_servers}, "
+                    f"profile: {settings.KAFKA_PRODUCER_PROFILE}"
+                )
             except Exception as e:
                 logger.error(f"Failed to initialize Kafka Producer: {e}")
                 raise
         return cls._producer
     
     
+    @staticmethod
+    def _serialize_value(value: Any) -> Optional[bytes]:
+        """
+        Кодирование значения сообщения.
+        
+        None - tombstone сжимаемого топика состояния, bytes - уже закодированное
+        сообщение (пересылка в DLQ и обратно); передаются без изменений.
+        """
+        if value is None or isinstance(value, (bytes, bytearray)):
+            return value
+        return json_codec.dumps(value)
+    
+    @staticmethod
+    def _producer_profile_config(profile: str) -> Dict[str, Any]:
+        """
+        Параметры producer-а для профиля KAFKA_PRODUCER_PROFILE.
+        
+        'reliable' - одно сообщение в полете на соединение, без пакетирования.
+        'throughput' - идемпотентный producer с до 5 запросами в полете (порядок
+        сообщений одного ключа сохраняется брокером по sequence number),
+        накоплением пачек linger_ms/batch_size и сжатием.
+        """
+        if profile == 'reliable':
+            return {
+                'acks': 'all',
+                'retries': 3,
+                'max_in_flight_requests_per_connection': 1,
+            }
+        if profile == 'throughput':
+            # enable_idempotence и delivery_timeout_ms есть в kafka-python начиная с 2.2.0
+            return {
+                'acks': 'all',
+                'enable_idempotence': True,
+                'retries': 2147483647,
+                'max_in_flight_requests_per_connection': 5,
+                'delivery_timeout_ms': settings.KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS,
+                'linger_ms': settings.KAFKA_PRODUCER_LINGER_MS,
+                'batch_size': settings.KAFKA_PRODUCER_BATCH_SIZE,
+                'compression_type': KafkaService._compression_type(settings.KAFKA_PRODUCER_COMPRESSION),
+            }
+        raise ValueError(f"Unknown KAFKA_PRODUCER_PROFILE: {profile}")
+    
+    @staticmethod
+    def _compression_type(compression: str) -> Optional[str]:
+        """Алгоритм сжатия; если библиотека кодека не установлена, используется gzip"""
+        if not compression or compression == 'none':
+            return None
+        available = {
+            'gzip': codec.has_gzip,
+            'snappy': codec.has_snappy,
+            'lz4': codec.has_lz4,
+            'zstd': codec.has_zstd,
+        }
+        if compression not in available:
+            raise ValueError(f"Unknown KAFKA_PRODUCER_COMPRESSION: {compression}")
+        if not available[compression]():
+            logger.warning(f"Compression codec '{compression}' is not installed, falling back to gzip")
+            return 'gzip'
+        return compression
+    
+    @classmethod
+    def send_record(cls, topic: str, key: Any = None, value: Any = None, headers: Optional[List[tuple]] = None):
+        """
+        Асинхронно отправить сообщение producer-ом процесса.
+        
+        Время до подтверждения брокера и неудачные отправки учитываются в
+        метриках kafka_producer_*. Возвращает future producer-а.
+        """
+        started = time.perf_counter()
+        try:
+            future = cls.get_producer().send(topic, key=key, value=value, headers=headers)
+        except Exception:
+            metrics.producer_send_failures.inc(topic=topic)
+            raise
+        future.add_callback(lambda _: metrics.producer_send_seconds.observe(time.perf_counter() - started, topic=topic))
+        future.add_errback(lambda _: metrics.producer_send_failures.inc(topic=topic))
+        return future
+    
+    @classmethod
+    def flush(cls, timeout: Optional[float] = None):
+        """
+        Дождаться отправки всех накопленных producer-ом сообщений.
+        
+        После flush у всех ранее полученных из send() future известен результат,
+        поэтому их future.get() не блокируется. Без созданного producer-а ничего не делает.
+        """
+        if cls._producer is not None:
+            cls._producer.flush(timeout=timeout)
+    
+    @staticmethod
+    def build_issue_message(event_type: str, issue_data: Dict[str, Any], issue_id: int) -> Dict[str, Any]:
+        """Сформировать сообщение о событии заявки в формате топика KAFKA_ISSUES_TOPIC"""
+        return {
+            'event_type': event_type,
+            'issue_id': issue_id,
+            'timestamp': issue_data.get('date_create') or issue_data.get('updated_at'),
+            'data': issue_data,
+            'source': 'django',
+            'version': '1.0'
+        }
+    
+    @classmethod
+    def publish_issue_event(cls, event_type: str, issue_data: Dict[str, Any], issue_id: int):
+        """
+        Опубликовать событие о заявке.
+        
+        При включенном KAFKA_OUTBOX_ENABLED событие записывается в таблицу OutboxEvents
+        в текущей транзакции БД, а в Kafka его доставляет relay_issue_events.
+        Ошибки записи не перехватываются: событие не должно потеряться при успешном коммите.
+        Иначе событие отправляется в Kafka синхронно (send_issue_event).
+        """
+        if not settings.KAFKA_OUTBOX_ENABLED:
+            cls.send_issue_event(event_type, issue_data, issue_id)
+            return
+        
+        from erp_tools.models import OutboxEvents
+        
+        OutboxEvents.objects.create(
+            event_type=event_type,
+            issue_id=issue_id,
+            payload=cls.build_issue_message(event_type, issue_data, issue_id),
+        )
+        logger.debug(f"Issue event queued in outbox: {event_type} for issue {issue_id}")
+    
+    @classmethod
+    def relay_outbox(cls, batch_size: int) -> int:
+        """
+        Отправить в Kafka очередную пачку событий из OutboxEvents.
+        
+        События одной заявки, попавшие в окно KAFKA_OUTBOX_COALESCE_WINDOW_MS,
+        объединяются в одно сообщение (см. _coalesce_messages). Заявка, по которой
+        события еще поступают, откладывается до конца окна, но не дольше
+        KAFKA_OUTBOX_COALESCE_MAX_DELAY_MS с момента первого события.
+        
+        Если задан KAFKA_ISSUES_STATE_TOPIC, вместе с событиями отправляется
+        текущее состояние заявок (см. _issue_state_messages). Строки STATE_EVENT
+        (изменения из 1С) в топик событий не отправляются, только состояние.
+        
+        Сообщения пачки отправляются без ожидания каждого подтверждения, затем
+        выполняется flush. Доставленные строки удаляются; при первой ошибке
+        отправленные после нее строки остаются в outbox, чтобы сохранить порядок
+        событий по заявке (доставка at-least-once).
+        
+        Returns:
+            Количество доставленных строк outbox
+        """
+        from erp_tools.models import OutboxEvents
+        
+        with transaction.atomic():
+            rows = list(OutboxEvents.objects.select_for_update().order_by('id')[:batch_size])
+            if not rows:
+                return 0
+            
+            groups = cls._group_outbox_rows(rows)
+            if not groups:
+                return 0
+            
+            # Пока цепь разомкнута, события остаются в outbox
+            if not cls._circuit.allow_request():
+                logger.debug("Kafka circuit is open, outbox relay postponed")
+                return 0
+            
+            states = cls._issue_state_messages(groups)
+            try:
+                futures = []
+                for index, group in enumerate(groups):
+                    key = str(group[0].issue_id)
+                    group_futures = []
+                    payloads = [row.payload for row in group if row.event_type != cls.STATE_EVENT]
+                    if payloads:
+                        group_futures.append(
+                            cls.send_record(
+                                settings.KAFKA_ISSUES_TOPIC,
+                                key=key,
+                                value=cls._coalesce_messages(payloads),
+                                headers=cls.SOURCE_HEADERS,
+                            )
+                        )
+                    if index in states:
+                        group_futures.append(
+                            cls.send_record(
+                                settings.KAFKA_ISSUES_STATE_TOPIC,
+                                key=key,
+                                value=states[index],
+                                headers=cls.SOURCE_HEADERS,
+                            )
+                        )
+                    futures.append(group_futures)
+                cls.flush(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+            except Exception:
+                cls._circuit.record_failure()
+                raise
+            
+            delivered_ids = []
+            for group, group_futures in zip(groups, futures):
+                try:
+                    for future in group_futures:
+                        future.get(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+                except Exception as e:
+                    cls._circuit.record_failure()
+                    row = group[0]
+                    row.attempts += 1
+                    row.last_error = str(e)
+                    row.save(update_fields=['attempts', 'last_error'])
+                    logger.warning(f"Failed to relay outbox event {row.pk} for issue {row.issue_id}: {e}")
+                    break
+                delivered_ids.extend(row.pk for row in group)
+            
+            if delivered_ids:
+                cls._circuit.record_success()
+                OutboxEvents.objects.filter(pk__in=delivered_ids).delete()
+        
+        logger.info(
+            f"Relayed {len(delivered_ids)} outbox events as {len(groups)} messages "
+            f"to topic {settings.KAFKA_ISSUES_TOPIC}"
+        )
+        return len(delivered_ids)
+    
+    @classmethod
+    def _issue_state_messages(cls, groups: List[List[Any]]) -> Dict[int, Optional[Dict[str, Any]]]:
+        """
+        Записи топика состояния для пачки outbox: {индекс группы: значение записи}.
+        
+        Состояние читается из БД одним запросом, поэтому оно не старше событий
+        группы при любом формате событий. Отправляется с последней группой заявки
+        в пачке; группы из одних комментариев состояние не меняют. Удаленной
+        заявке соответствует tombstone (None).
+        """
+        if not settings.KAFKA_ISSUES_STATE_TOPIC:
+            return {}
+        
+        from erp_tools.models import Issues
+        
+        last_group = {}
+        for index, group in enumerate(groups):
+            if any(row.event_type != 'comment_added' for row in group):
+                last_group[group[0].issue_id] = index
+        if not last_group:
+            return {}
+        
+        issues = Issues.objects.in_bulk(list(last_group))
+        return {
+            index: cls.build_state_message(
+                issue_id, serialize_issue(issues[issue_id]) if issue_id in issues else None
+            )
+            for issue_id, index in last_group.items()
+        }
+    
+    @staticmethod
+    def _group_outbox_rows(rows: List[Any]) -> List[List[Any]]:
+        """
+        Разбить строки outbox на группы, каждая из которых отправляется одним сообщением.
+        
+        Без окна объединения каждая строка - отдельная группа. С окном строки
+        группируются по заявке; группа откладывается, если последнее событие
+        моложе окна, а первое - моложе максимальной задержки.
+        """
+        window = settings.KAFKA_OUTBOX_COALESCE_WINDOW_MS
+        if window <= 0:
+            return [[row] for row in rows]
+        
+        by_issue = {}
+        for row in rows:
+            by_issue.setdefault(row.issue_id, []).append(row)
+        
+        now = timezone.now()
+        settle_after = now - timedelta(milliseconds=window)
+        deadline = now - timedelta(milliseconds=settings.KAFKA_OUTBOX_COALESCE_MAX_DELAY_MS)
+        return [
+            group
+            for group in by_issue.values()
+            if group[-1].date_create <= settle_after or group[0].date_create <= deadline
+        ]
+    
+    @staticmethod
+    def _coalesce_messages(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Объединить сообщения об одной заявке в одно.
+        
+        Данные заявки берутся из последнего снимка, дельты объединяются (новые
+        значения - последние, старые - первые). Тип события: 'deleted', если
+        заявка удалена; 'created', если она создана в этой группе; 'status_changed',
+        если итоговый статус отличается от исходного; иначе 'updated'. Если в группе
+        есть комментарии, к типу добавляется '_with_comment', а комментарий
+        передается в data['comment'] (все комментарии - в data['comments']).
+        
+        Объединенные типы необязательны для получателей: без окна объединения и
+        при отправке напрямую (KAFKA_OUTBOX_ENABLED=False) те же изменения
+        приходят отдельными событиями.
+        """
+        if len(messages) == 1:
+            return messages[0]
+        
+        last = messages[-1]
+        event_types = [message['event_type'] for message in messages]
+        comments = []
+        issue_messages = []
+        for message in messages:
+            if message['event_type'] == 'comment_added':
+                comment = dict(message['data'])
+                comment.pop('issue_id', None)
+                comments.append(comment)
+            else:
+                issue_messages.append(message)
+        
+        if 'deleted' in event_types:
+            deleted = [message for message in messages if message['event_type'] == 'deleted'][-1]
+            return {**deleted, 'coalesced_events': len(messages)}
+        
+        if not issue_messages:
+            data = {**last['data'], 'comments': comments}
+            return {**last, 'data': data, 'coalesced_events': len(messages)}
+        
+        state = None
+        old_status = None
+        for message in issue_messages:
+            data = message['data']
+            if old_status is None and data.get('old_status'):
+                old_status = data['old_status']
+            if data.get('format') == 'delta':
+                if state is None:
+                    state = {'id': data['id'], 'format': 'delta', 'changed': {}, 'old': {}}
+                if state.get('format') == 'delta':
+                    for key, value in data['old'].items():
+                        state['old'].setdefault(key, value)
+                    state['changed'].update(data['changed'])
+                else:
+                    state.update(data['changed'])
+            else:
+                state = {key: value for key, value in data.items() if key not in ('old_status', 'new_status')}
+        
+        if state.get('format') == 'delta':
+            new_status = state['changed'].get('status')
+        else:
+            new_status = state.get('status')
+        
+        if event_types[0] == 'created':
+            event_type = 'created'
+        elif old_status and new_status and old_status != new_status:
+            event_type = 'status_changed'
+            state['old_status'] = old_status
+            state['new_status'] = new_status
+        else:
+            event_type = 'updated'
+        
+        if comments:
+            event_type = f'{event_type}_with_comment'
+            state['comment'] = comments[-1]
+            if len(comments) > 1:
+                state['comments'] = comments
+        
+        message = KafkaService.build_issue_message(event_type, state, last['issue_id'])
+        message['timestamp'] = next(
+            (m['timestamp'] for m in reversed(messages) if m.get('timestamp')), None
+        )
+        message['coalesced_events'] = len(messages)
+        return message
+    
     @classmethod
     def send_issue_event(cls, event_type: str, issue_data: Dict[str, Any], issue_id: int):
         """
-        Отправить событие о заявке в Kafka
+        Отправить событие о заявке в Kafka (при недоступном брокере - через локальный буфер)
         
         Args:
             event_type: Тип события ('created', 'updated', 'status_changed', 'deleted', 'comment_added')
             issue_data: Данные заявки
             issue_id: ID заявки
         """
-        try:
-            producer = cls.get_producer()
-            
-            message = {
-                'event_type': event_type,
-                'issue_id': issue_id,
-                'timestamp': issue_data.get('date_create') or issue_data.get('updated_at'),
-                'data': issue_data,
-                'source': 'django',
-                'version': '1.0'
-            }
+        message = cls.build_issue_message(event_type, issue_data, issue_id)
+        if cls._send_direct(settings.KAFKA_ISSUES_TOPIC, str(issue_id), message):
+            logger.info(f"Issue event sent: {event_type} for issue {issue_id}")
+        else:
+            logger.info(f"Issue event spooled: {event_type} for issue {issue_id}")
+    
+    @classmethod
+    def publish_issue_state(cls, issue_id: int, snapshot: Optional[Dict[str, Any]]):
+        """
+        Опубликовать текущее состояние заявки в сжимаемый топик KAFKA_ISSUES_STATE_TOPIC.
+        
+        snapshot=None - удаление заявки (tombstone). При включенном outbox ничего
+        не делает: состояние публикует relay_outbox по данным БД.
+        """
+        if not settings.KAFKA_ISSUES_STATE_TOPIC or settings.KAFKA_OUTBOX_ENABLED:
+            return
+        cls._send_direct(settings.KAFKA_ISSUES_STATE_TOPIC, str(issue_id), cls.build_state_message(issue_id, snapshot))
+    
+    @classmethod
+    def publish_issue_states(cls, issue_ids: Iterable[int]):
+        """
+        Опубликовать состояние заявок, измененных без события в топике событий (данные из 1С).
+        
+        Подавление эха касается только топика событий: потребители топика состояния
+        должны видеть и изменения из 1С. При включенном outbox в текущей транзакции
+        записываются строки STATE_EVENT, иначе состояние отправляется после коммита.
+        """
+        issue_ids = list(dict.fromkeys(issue_ids))
+        if not settings.KAFKA_ISSUES_STATE_TOPIC or not issue_ids:
+            return
+        if settings.KAFKA_OUTBOX_ENABLED:
+            from erp_tools.models import OutboxEvents
             
-            future = producer.send(
-                settings.KAFKA_ISSUES_TOPIC,
-                key=str(issue_id),
-                value=message
+            OutboxEvents.objects.bulk_create(
+                [OutboxEvents(event_type=cls.STATE_EVENT, issue_id=issue_id, payload={}) for issue_id in issue_ids]
             )
-            
+            return
+        transaction.on_commit(lambda: cls._send_issue_states(issue_ids))
+    
+    @classmethod
+    def _send_issue_states(cls, issue_ids: List[int]):
+        from erp_tools.models import Issues
+        
+        issues = Issues.objects.in_bulk(issue_ids)
+        for issue_id in issue_ids:
+            snapshot = serialize_issue(issues[issue_id]) if issue_id in issues else None
+            cls._send_direct(
+                settings.KAFKA_ISSUES_STATE_TOPIC, str(issue_id), cls.build_state_message(issue_id, snapshot)
+            )
+    
+    @classmethod
+    def build_state_message(cls, issue_id: int, snapshot: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Значение записи топика состояния: снимок заявки или None (tombstone)"""
+        if snapshot is None:
+            return None
+        return cls.build_issue_message('snapshot', snapshot, issue_id)
+    
+    @classmethod
+    def _send_direct(cls, topic: str, key: str, message: Optional[Dict[str, Any]]) -> bool:
+        """
+        Синхронно отправить сообщение в Kafka.
+        
+        Если брокер недоступен (цепь разомкнута или отправка не удалась), либо в
+        локальном буфере еще есть недоставленные сообщения, сообщение добавляется
+        в буфер и отправляется фоновым потоком после восстановления брокера в
+        исходном порядке.
+        
+        Returns:
+            True, если сообщение доставлено, False - если оно помещено в буфер
+        """
+        if (cls._spool is not None and cls._spool.pending()) or not cls._circuit.allow_request():
+            cls._spool_message(topic, key, message)
+            return False
+        
+        try:
+            future = cls.send_record(topic, key=key, value=message, headers=cls.SOURCE_HEADERS)
+            record_metadata = future.get(timeout=10)
+        except Exception as e:
+            cls._circuit.record_failure()
+            logger.error(f"Failed to send message with key {key} to topic {topic}, spooling: {e}")
+            cls._spool_message(topic, key, message)
+            return False
+        
+        cls._circuit.record_success()
+        logger.info(
+            f"Message sent to topic={record_metadata.topic} "
+            f"partition={record_metadata.partition} "
+            f"offset={record_metadata.offset}"
+        )
+        return True
+    
+    @classmethod
+    def _spool_message(cls, topic: str, key: str, message: Optional[Dict[str, Any]]):
+        """Добавить сообщение в локальный буфер процесса и запустить его фоновую доставку"""
+        with cls._spool_lock:
             try:
-                record_metadata = future.get(timeout=10)
-                logger.info(
-                    f"Message sent to topic={record_metadata.topic} "
-                    f"partition={record_metadata.partition} "
-                    f"offset={record_metadata.offset}"
-                )
+                if cls._spool is None:
+                    cls._spool = cls._open_spool(f"{socket.gethostname()}-{os.getpid()}")
+                cls._spool.append({'topic': topic, 'key': key, 'value': message})
             except Exception as e:
-                logger.warning(f"Could not get message confirmation: {e}")
+                logger.error(f"Failed to spool Kafka message for key {key}, message lost: {e}", exc_info=True)
+                return
             
-            logger.info(f"Issue event sent: {event_type} for issue {issue_id}")
+            if cls._spool_thread is None or not cls._spool_thread.is_alive():
+                cls._spool_thread = threading.Thread(target=cls._drain_own_spool, daemon=True)
+                cls._spool_thread.start()
+    
+    @staticmethod
+    def _open_spool(name: str) -> DiskSpool:
+        return DiskSpool(
+            Path(settings.KAFKA_SPOOL_DIR) / name,
+            segment_bytes=settings.KAFKA_SPOOL_SEGMENT_BYTES,
+            fsync_every=settings.KAFKA_SPOOL_FSYNC_EVERY,
+            fsync_interval=settings.KAFKA_SPOOL_FSYNC_INTERVAL,
+        )
+    
+    @classmethod
+    def _drain_own_spool(cls):
+        """Фоновый поток: доставлять буфер процесса, пока он не опустеет"""
+        while True:
+            with cls._spool_lock:
+                if cls._spool is None or not cls._spool.pending():
+                    cls._spool_thread = None
+                    return
+            if not cls._circuit.allow_request():
+                time.sleep(1.0)
+                continue
+            try:
+                delivered = cls._spool.replay(cls._deliver_spooled, settings.KAFKA_OUTBOX_BATCH_SIZE)
+            except Exception as e:
+                cls._circuit.record_failure()
+                logger.warning(f"Failed to replay spooled Kafka messages: {e}")
+                time.sleep(1.0)
+                continue
+            cls._circuit.record_success()
+            logger.info(f"Replayed {delivered} spooled Kafka messages")
+    
+    @classmethod
+    def _deliver_spooled(cls, records: List[Dict[str, Any]]):
+        """Отправить пачку записей буфера и дождаться подтверждения каждой"""
+        futures = [
+            cls.send_record(record['topic'], key=record['key'], value=record['value'], headers=cls.SOURCE_HEADERS)
+            for record in records
+        ]
+        cls.flush(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+        for future in futures:
+            future.get(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+    
+    @classmethod
+    def drain_spools(cls) -> int:
+        """
+        Доставить буферы завершившихся процессов из KAFKA_SPOOL_DIR.
+        
+        Буферы работающих процессов заняты ими (flock) и пропускаются.
+        
+        Returns:
+            Количество доставленных сообщений
+        """
+        base = Path(settings.KAFKA_SPOOL_DIR)
+        if not base.is_dir():
+            return 0
+        
+        delivered = 0
+        for directory in sorted(base.iterdir()):
+            if not directory.is_dir():
+                continue
+            try:
+                spool = cls._open_spool(directory.name)
+            except BlockingIOError:
+                continue
+            try:
+                if not spool.pending():
+                    continue
+                if not cls._circuit.allow_request():
+                    break
+                delivered += spool.replay(cls._deliver_spooled, settings.KAFKA_OUTBOX_BATCH_SIZE)
+                cls._circuit.record_success()
+            except Exception as e:
+                cls._circuit.record_failure()
+                logger.warning(f"Failed to replay Kafka spool {directory}: {e}")
+                break
+            finally:
+                spool.close()
+        
+        if delivered:
+            logger.info(f"Replayed {delivered} messages from Kafka spools of finished processes")
+        return delivered
+    
+    @classmethod
+    def close_spool(cls):
+        """Сбросить буфер процесса на диск; недоставленное доставит drain_spools"""
+        with cls._spool_lock:
+            if cls._spool is not None:
+                cls._spool.close()
+                cls._spool = None
+    
+    @classmethod
+    def create_consumer(cls, listener=None) -> KafkaConsumer:
+        """
+        Создать Kafka Consumer, подписанный на топики событий заявок
+        
+        Args:
+            listener: ConsumerRebalanceListener, уведомляемый о ребалансировке
+        """
+        bootstrap_servers = settings.KAFKA_BOOTSTRAP_SERVERS.split(',')
+        logger.info(f"Attempting to connect to Kafka brokers: {bootstrap_servers}")
+        
+        # Базовая конфигурация Consumer
+        consumer_config = {
+            'bootstrap_servers': bootstrap_servers,
+            'group_id': settings.KAFKA_CONSUMER_GROUP,
+            # Значения декодируются после проверки заголовка source (см. _decode_records)
+            'key_deserializer': lambda k: k.decode('utf-8') if k else None,
+            'auto_offset_reset': settings.KAFKA_CONSUMER_OFFSET_RESET,
+            # Offset фиксируется вручную только после коммита транзакции БД
+            'enable_auto_commit': False,
+            'consumer_timeout_ms': 1000,
+        }
+        
+        # Собственный топик событий Django читать не нужно: consumer обрабатывает только события 1С
+        topics = [settings.KAFKA_ISSUES_1C_TOPIC]
+        if settings.KAFKA_CONSUMER_SUBSCRIBE_OWN_TOPIC:
+            topics.insert(0, settings.KAFKA_ISSUES_TOPIC)
+        logger.info(f"Subscribing to topics: {topics}")
+        consumer = KafkaConsumer(**consumer_config)
+        consumer.subscribe(topics, listener=listener)
+        
+        logger.info(f"Successfully connected to Kafka and subscribed to topics: {', '.join(topics)}")
+        return consumer
+    
+    @classmethod
+    def run_consumer(cls):
+        """
+        Цикл обработки сообщений от 1С в текущем потоке.
+        
+        Блокирует вызывающий поток до stop_consumer(). Используется как фоновым
+        потоком start_consumer(), так и процессами команды run_kafka_consumer.
+        """
+        cls._running = True
+        consumer = None
+        dispatcher = None
+        tracker = OffsetTracker()
+        retries = RetryScheduler(
+            settings.KAFKA_CONSUMER_RETRY_ATTEMPTS,
+            base_delay=settings.KAFKA_CONSUMER_RETRY_BASE_DELAY,
+            max_delay=settings.KAFKA_CONSUMER_RETRY_MAX_DELAY,
+        )
+        try:
+            if settings.KAFKA_CONSUMER_THREADS > 1:
+                dispatcher = KeyedDispatcher(
+                    settings.KAFKA_CONSUMER_THREADS,
+                    lambda records: cls._apply_with_retries(records, retries),
+                    queue_size=settings.KAFKA_CONSUMER_QUEUE_SIZE,
+                    batch_size=settings.KAFKA_CONSUMER_WORKER_BATCH_SIZE,
+                    tracker=tracker,
+                )
+                logger.info(f"Consumer dispatches messages to {settings.KAFKA_CONSUMER_THREADS} worker threads")
+            listener = DrainOnRevokeListener(
+                tracker, lambda: cls._commit_processed(consumer, tracker), dispatcher, retries
+            )
+            consumer = cls.create_consumer(listener)
+            cls._consumer = consumer
             
-        except KafkaError as e:
-            logger.error(f"Kafka error while sending issue event: {e}")
+            last_prune = 0.0
+            last_metrics = time.monotonic()
+            consumed = 0
+            committed = {}
+            while cls._running:
+                try:
+                    if time.monotonic() - last_prune >= settings.KAFKA_PROCESSED_MESSAGES_PRUNE_INTERVAL:
+                        cls.prune_processed_messages()
+                        last_prune = time.monotonic()
+                    
+                    message_pack = consumer.poll(timeout_ms=1000)
+                    if message_pack:
+                        reference_cache.sync()
+                        records = [record for records in message_pack.values() for record in records]
+                        consumed += len(records)
+                        if dispatcher is not None:
+                            cls._dispatch_records(dispatcher, records, retries)
+                        else:
+                            cls._process_records(tracker, records, retries)
+                    cls._process_due_retries(tracker, retries, dispatcher)
+                    committed.update(cls._commit_processed(consumer, tracker))
+                    
+                    elapsed = time.monotonic() - last_metrics
+                    if elapsed >= settings.KAFKA_CONSUMER_METRICS_INTERVAL:
+                        cls._update_consumer_metrics(consumer, committed, consumed / elapsed, retries)
+                        last_metrics += elapsed
+                        consumed = 0
+                except Exception as e:
+                    if cls._running:
+                        logger.error(f"Error in consumer loop: {e}", exc_info=True)
+                        
         except Exception as e:
-            logger.error(f"Unexpected error while sending issue event: {e}", exc_info=True)
+            logger.error(f"Error in consumer thread: {e}", exc_info=True)
+        finally:
+            if dispatcher is not None:
+                dispatcher.stop()
+            if consumer:
+                # Offset-ы отложенных повторов не фиксируются: после рестарта они будут прочитаны снова
+                try:
+                    cls._commit_processed(consumer, tracker)
+                except Exception as e:
+                    logger.warning(f"Failed to commit offsets on shutdown: {e}")
+                consumer.close()
+            cls._consumer = None
+            cls._running = False
+            logger.info("Kafka Consumer thread stopped")
     
     @classmethod
     def start_consumer(cls):
-        """Запустить Kafka Consumer для получения событий от 1С"""
+        """Запустить Kafka Consumer для получения событий от 1С в фоновом потоке"""
         if cls._running:
             logger.warning("Consumer is already running")
             return
@@ -101,75 +785,29 @@ class KafkaService:
             logger.warning("Consumer thread is already running")
             return
         
-        def consume_messages():
-            cls._running = True
-            consumer = None
-            try:
-                bootstrap_servers = settings.KAFKA_BOOTSTRAP_SERVERS.split(',')
-                logger.info(f"Attempting to connect to Kafka brokers: {bootstrap_servers}")
-                
-                # Базовая конфигурация Consumer
-                consumer_config = {
-                    'bootstrap_servers': bootstrap_servers,
-                    'group_id': settings.KAFKA_CONSUMER_GROUP,
-                    'value_deserializer': lambda m: json.loads(m.decode('utf-8')),
-                    'key_deserializer': lambda k: k.decode('utf-8') if k else None,
-                    'auto_offset_reset': 'latest',
-                    'enable_auto_commit': True,
-                    'consumer_timeout_ms': 1000,
-                }
-                
-                # Подписываемся на оба топика
-                topics = [settings.KAFKA_ISSUES_TOPIC, settings.KAFKA_ISSUES_1C_TOPIC]
-                logger.info(f"Subscribing to topics: {topics}")
-                consumer = KafkaConsumer(
-                    *topics,
-                    **consumer_config
-                )
-                
-                logger.info(f"Successfully connected to Kafka and subscribed to topics: {', '.join(topics)}")
-                cls._consumer = consumer
-                
-                while cls._running:
-                    try:
-                        message_pack = consumer.poll(timeout_ms=1000)
-                        for topic_partition, messages in message_pack.items():
-                            for message in messages:
-                                try:
-                                    cls._process_1c_message(message.value)
-                                except Exception as e:
-                                    logger.error(f"Error processing message from 1C: {e}", exc_info=True)
-                    except Exception as e:
-                        if cls._running:
-                            logger.error(f"Error in consumer loop: {e}", exc_info=True)
-                            
-            except Exception as e:
-                logger.error(f"Error in consumer thread: {e}", exc_info=True)
-            finally:
-                if consumer:
-                    consumer.close()
-                cls._running = False
-                logger.info("Kafka Consumer thread stopped")
-        
-        cls._consumer_thread = threading.Thread(target=consume_messages, daemon=True)
+        cls._consumer_thread = threading.Thread(target=cls.run_consumer, daemon=True)
         cls._consumer_thread.start()
         logger.info("Kafka Consumer thread started")
-        
-        atexit.register(cls.stop_consumer)
     
     @classmethod
-    def stop_consumer(cls):
-        """Остановить Kafka Consumer"""
+    def stop_consumer(cls, timeout: float = 5.0):
+        """
+        Остановить Kafka Consumer.
+        
+        Цикл run_consumer завершает текущий poll и сам закрывает consumer;
+        фоновый поток ожидается не дольше timeout секунд.
+        """
         cls._running = False
-        if cls._consumer:
-            cls._consumer.close()
+        thread = cls._consumer_thread
+        if thread is None:
+            return
+        if thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout)
         logger.info("Kafka Consumer stopped")
     
     @classmethod
     def _process_1c_message(cls, message: Dict[str, Any]):
         """Обработать сообщение от 1С"""
-        from erp_tools.models import Issues, IssueComments, Users, Companies, Services, DataBases
-        
         event_type = message.get('event_type')
         issue_data = message.get('data', {})
         issue_id = message.get('issue_id')
@@ -182,26 +820,552 @@ class KafkaService:
         logger.info(f"Processing 1C message: {event_type} for issue {issue_id}")
         
         try:
-            if event_type == 'created':
-                cls._create_issue_from_1c(issue_data)
-            elif event_type == 'updated':
-                if issue_id:
-                    cls._update_issue_from_1c(issue_id, issue_data)
-            elif event_type == 'status_changed':
-                if issue_id:
-                    cls._update_issue_status_from_1c(issue_id, issue_data)
-            elif event_type == 'comment_added':
-                if issue_id:
-                    cls._add_comment_from_1c(issue_id, issue_data)
-            else:
-                logger.warning(f"Unknown event type: {event_type}")
+            cls._apply_1c_message(message)
         except Exception as e:
             logger.error(f"Error processing 1C event {event_type}: {e}", exc_info=True)
     
     @classmethod
-    def _create_issue_from_1c(cls, issue_data: Dict[str, Any]):
-        """Создать заявку из данных 1С"""
-        from erp_tools.models import Issues, Companies, Services, DataBases, Users
+    def _apply_1c_message(cls, message: Dict[str, Any]):
+        """
+        Применить одно сообщение от 1С; ошибки пробрасываются вызывающему.
+        
+        Ненайденная заявка - Issues.DoesNotExist (сообщение повторяется: событие
+        'created' могло еще не дойти), некорректное сообщение - Unprocessable1CMessage.
+        """
+        from erp_tools.models import Issues
+        
+        event_type = message.get('event_type')
+        issue_data = message.get('data', {})
+        
+        if event_type == 'created':
+            cls._create_issue_from_1c(issue_data, cls._external_key(message))
+            return
+        if event_type not in ('updated', 'status_changed', 'comment_added'):
+            raise Unprocessable1CMessage(f"Unknown event type: {event_type}")
+        
+        external_key = cls._external_key(message)
+        if not message.get('issue_id') and not external_key:
+            raise Unprocessable1CMessage(f"No issue_id or external_id in {event_type} from 1C")
+        issue_id = cls._resolve_issue_id(message)
+        if issue_id is None:
+            raise Issues.DoesNotExist(f"Issue {external_key} not found for {event_type} from 1C")
+        
+        if event_type == 'updated':
+            cls._update_issue_from_1c(issue_id, issue_data)
+        elif event_type == 'status_changed':
+            cls._update_issue_status_from_1c(issue_id, issue_data)
+        else:
+            cls._add_comment_from_1c(issue_id, issue_data)
+    
+    @classmethod
+    def _process_records(cls, tracker: OffsetTracker, records: List[Any], retries: RetryScheduler):
+        """
+        Обработать сообщения consumer.poll в текущем потоке.
+
+        Offset-ы регистрируются в tracker и отмечаются обработанными, кроме
+        отложенных для повтора: фиксация партиции останавливается на первом
+        отложенном сообщении до его обработки или отправки в DLQ.
+        """
+        for record in records:
+            tracker.add(TopicPartition(record.topic, record.partition), record.offset)
+        decoded, failures = cls._decode_records(records)
+        pending = {cls._record_id(record) for record in decoded + cls._handle_failures(failures, retries)}
+        finished = [record for record in records if cls._record_id(record) not in pending]
+        cls._mark_done(tracker, finished + cls._apply_with_retries(decoded, retries))
+
+    @classmethod
+    def _dispatch_records(cls, dispatcher: KeyedDispatcher, records: List[Any], retries: RetryScheduler):
+        """
+        Распределить сообщения consumer.poll по рабочим потокам dispatcher-а.
+
+        Собственные сообщения сразу учитываются как обработанные, чтобы не
+        задерживать фиксацию offset-ов партиции; нечитаемые отправляются в DLQ.
+        """
+        decoded, failures = cls._decode_records(records)
+        deferred = {cls._record_id(record) for record in cls._handle_failures(failures, retries)}
+        decoded = {cls._record_id(record): record for record in decoded}
+        for record in records:
+            record_id = cls._record_id(record)
+            if record_id in decoded:
+                dispatcher.submit(cls._ordering_key(decoded[record_id]), decoded[record_id])
+            elif record_id in deferred:
+                dispatcher.tracker.add(TopicPartition(record.topic, record.partition), record.offset)
+            else:
+                dispatcher.skip(record)
+
+    @classmethod
+    def _process_due_retries(
+        cls, tracker: OffsetTracker, retries: RetryScheduler, dispatcher: Optional[KeyedDispatcher] = None
+    ):
+        """
+        Повторить отложенные сообщения, время которых наступило.
+
+        Декодированные сообщения применяются заново (в потоке dispatcher-а
+        по своему ключу) вместе с ждавшими за ними сообщениями того же ключа,
+        нечитаемые - повторно отправляются в DLQ.
+        """
+        due = retries.pop_due()
+        if not due:
+            return
+        decoded = [record for record in due if isinstance(record.value, dict)]
+        undecodable = [record for record in due if not isinstance(record.value, dict)]
+        logger.info(f"Retrying {len(due)} deferred messages from 1C")
+
+        failures = [(record, retries.last_error(record)) for record in undecodable]
+        deferred = {cls._record_id(record) for record in cls._handle_failures(failures, retries)}
+        finished = [record for record in undecodable if cls._record_id(record) not in deferred]
+        if dispatcher is not None:
+            for record in decoded:
+                dispatcher.resubmit(cls._ordering_key(record), record)
+        else:
+            finished += cls._apply_with_retries(decoded, retries)
+        cls._mark_done(tracker, finished)
+
+    @classmethod
+    def _apply_with_retries(cls, records: List[Any], retries: RetryScheduler) -> List[Any]:
+        """
+        Применить декодированные сообщения; сообщения с ошибкой отложить для
+        повтора или отправить в DLQ.
+
+        Сообщения одного ключа (заявки) применяются по порядку: пока у ключа
+        есть отложенное сообщение, следующие ждут за ним в RetryScheduler и
+        применяются вслед за ним при повторе. Возвращает сообщения, обработка
+        которых завершена (применены или отправлены в DLQ), в том числе
+        дождавшиеся повтора.
+        """
+        finished = []
+        while records:
+            admitted = []
+            for record in records:
+                admitted += retries.admit(cls._ordering_key(record), record)
+            failures, held = cls._apply_records(admitted)
+            pending = {cls._record_id(record) for record, error in failures}
+            pending.update(cls._record_id(record) for record in held)
+            for record in admitted:
+                if cls._record_id(record) not in pending:
+                    retries.discard(record)
+                    metrics.consumer_messages.inc(topic=record.topic, outcome='applied')
+                    finished.append(record)
+            deferred = {cls._record_id(record) for record in cls._handle_failures(failures, retries)}
+            finished += [record for record, error in failures if cls._record_id(record) not in deferred]
+            # Сообщения после ошибки встают за отложенным; если оно ушло в DLQ, применяются сразу
+            records = held
+        return finished
+
+    @classmethod
+    def _apply_records(cls, records: List[Any]) -> Tuple[List[Tuple[Any, Exception]], List[Any]]:
+        """
+        Применить декодированные сообщения.
+
+        Уже обработанные сообщения (ProcessedMessages) пропускаются, остальные
+        применяются и отмечаются обработанными в той же транзакции, поэтому
+        повторная доставка после рестарта или ребалансировки ничего не меняет.
+        В пакетном режиме пачка применяется целиком; если это не удалось,
+        транзакция откатывается и сообщения обрабатываются по одному, чтобы одно
+        некорректное сообщение не блокировало остальные. После ошибки следующие
+        сообщения того же ключа не применяются, чтобы не обогнать сообщение с ошибкой.
+
+        Возвращает сообщения, которые не удалось применить, с ошибкой и
+        сообщения, пропущенные после ошибки.
+        """
+        if not records:
+            return [], []
+
+        if settings.KAFKA_CONSUMER_BATCH_MODE:
+            try:
+                started = time.perf_counter()
+                with transaction.atomic():
+                    fresh = cls._exclude_processed(records)
+                    cls._process_1c_batch([record.value for record in fresh])
+                    cls._mark_processed(fresh)
+                # Время пачки распределяется между ее сообщениями поровну
+                share = (time.perf_counter() - started) / max(len(fresh), 1)
+                for record in fresh:
+                    metrics.consumer_apply_seconds.observe(share, event_type=record.value.get('event_type'))
+                return [], []
+            except Exception as e:
+                logger.warning(f"Error processing 1C batch, falling back to single messages: {e}")
+
+        failures = []
+        held = []
+        failed_keys = set()
+        for record in records:
+            key = cls._ordering_key(record)
+            if key is not None and key in failed_keys:
+                held.append(record)
+                continue
+            try:
+                with metrics.consumer_apply_seconds.time(event_type=record.value.get('event_type')):
+                    with transaction.atomic():
+                        if not cls._exclude_processed([record]):
+                            continue
+                        if record.value.get('source', '1c') != 'django':
+                            cls._apply_1c_message(record.value)
+                        cls._mark_processed([record])
+            except Exception as e:
+                failures.append((record, e))
+                if key is not None:
+                    failed_keys.add(key)
+        return failures, held
+
+    @classmethod
+    def _handle_failures(cls, failures: List[Tuple[Any, Exception]], retries: RetryScheduler) -> List[Any]:
+        """
+        Отложить сообщения с ошибкой для повтора с экспоненциальной задержкой.
+
+        Сообщения с исчерпанными попытками и Unprocessable1CMessage отправляются
+        в KAFKA_ISSUES_1C_DLQ_TOPIC. Если DLQ недоступна, сообщение снова
+        откладывается. Отложенное декодированное сообщение задерживает следующие
+        сообщения своего ключа. Возвращает отложенные сообщения.
+        """
+        deferred = []
+        for record, error in failures:
+            location = f"{record.topic}[{record.partition}]@{record.offset}"
+            key = cls._ordering_key(record) if isinstance(record.value, dict) else None
+            if not isinstance(error, Unprocessable1CMessage) and retries.schedule(record, error, key=key):
+                logger.warning(
+                    f"Failed to process message {location} (attempt {retries.attempts(record)}), "
+                    f"retry scheduled: {error}"
+                )
+                metrics.consumer_messages.inc(topic=record.topic, outcome='retried')
+                deferred.append(record)
+                continue
+
+            attempts = max(retries.attempts(record), 1)
+            logger.error(f"Message {location} failed after {attempts} attempts, moving to DLQ: {error}")
+            if cls._dead_letter(record, error, attempts):
+                retries.discard(record)
+                metrics.consumer_messages.inc(topic=record.topic, outcome='dead_lettered')
+            else:
+                retries.schedule(record, error, force=True, key=key)
+                deferred.append(record)
+        return deferred
+
+    @classmethod
+    def _dead_letter(cls, record, error: Exception, attempts: int) -> bool:
+        """
+        Отправить сообщение в KAFKA_ISSUES_1C_DLQ_TOPIC с описанием ошибки в заголовках x-*.
+
+        Тело (исходные байты, см. decoded_record_type) и исходные заголовки сохраняются,
+        чтобы redrive_dlq мог вернуть сообщение в исходный топик без изменений.
+        Ожидает подтверждения брокера.
+        """
+        headers = [(key, value) for key, value in record.headers or [] if not key.startswith('x-')]
+        headers += [
+            ('x-error', str(error)[:1000].encode('utf-8')),
+            ('x-error-type', type(error).__name__.encode('utf-8')),
+            ('x-original-topic', record.topic.encode('utf-8')),
+            ('x-original-partition', str(record.partition).encode('utf-8')),
+            ('x-original-offset', str(record.offset).encode('utf-8')),
+            ('x-attempts', str(attempts).encode('utf-8')),
+            ('x-failed-at', timezone.now().isoformat().encode('utf-8')),
+        ]
+        topic = settings.KAFKA_ISSUES_1C_DLQ_TOPIC
+        try:
+            # Исходные байты сообщения, а не повторно закодированный словарь
+            value = getattr(record, 'raw_value', record.value)
+            future = cls.send_record(topic, key=record.key, value=value, headers=headers)
+            future.get(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Failed to send message {record.topic}[{record.partition}]@{record.offset} to {topic}: {e}")
+            return False
+        return True
+
+    @staticmethod
+    def _record_id(record) -> tuple:
+        return record.topic, record.partition, record.offset
+    
+    @staticmethod
+    def _mark_done(tracker: OffsetTracker, records: List[Any]):
+        """Отметить обработанными offset-ы сообщений"""
+        for record in records:
+            tracker.done(TopicPartition(record.topic, record.partition), record.offset)
+    
+    @classmethod
+    def _ordering_key(cls, record) -> Any:
+        """
+        Ключ упорядочивания сообщения от 1С.
+        
+        Используется ключ сообщения Kafka: по нему 1С распределяет сообщения
+        заявки по партициям. Без ключа - внешний идентификатор или id заявки.
+        """
+        if record.key is not None:
+            return record.key
+        message = record.value
+        return cls._external_key(message) or message.get('issue_id') or message.get('data', {}).get('id')
+    
+    @staticmethod
+    def _commit_processed(consumer: KafkaConsumer, tracker: OffsetTracker) -> Dict[TopicPartition, int]:
+        """Зафиксировать offset-ы, до которых все сообщения обработаны; возвращает зафиксированные"""
+        committable = tracker.pop_committable()
+        if committable:
+            consumer.commit({tp: OffsetAndMetadata(offset, '', -1) for tp, offset in committable.items()})
+        return committable
+    
+    @staticmethod
+    def _update_consumer_metrics(
+        consumer: KafkaConsumer, committed: Dict[TopicPartition, int], throughput: float, retries: RetryScheduler
+    ):
+        """
+        Обновить метрики consumer-а: скорость чтения, отложенные повторы и
+        отставание назначенных партиций (high watermark минус последний
+        зафиксированный этим процессом offset, до первой фиксации - позиция чтения).
+        """
+        metrics.consumer_throughput.set(throughput)
+        metrics.consumer_retry_pending.set(len(retries))
+        metrics.consumer_lag.clear()
+        try:
+            for tp in consumer.assignment():
+                highwater = consumer.highwater(tp)
+                if highwater is None:
+                    continue
+                offset = committed.get(tp)
+                if offset is None:
+                    offset = consumer.position(tp)
+                metrics.consumer_lag.set(max(highwater - offset, 0), topic=tp.topic, partition=tp.partition)
+        except Exception as e:
+            logger.debug(f"Failed to compute consumer lag: {e}")
+    
+    @classmethod
+    def _decode_records(cls, records: List[Any]) -> Tuple[List[Any], List[Tuple[Any, Exception]]]:
+        """
+        Отбросить собственные сообщения Django по заголовку source и декодировать JSON остальных.
+        
+        Проверка заголовка не требует разбора тела сообщения. Сообщения без
+        заголовка (например, от 1С) декодируются и фильтруются по полю source.
+        Возвращает декодированные сообщения (decoded_record_type) и нечитаемые с ошибкой.
+        """
+        decoded = []
+        failures = []
+        for record in records:
+            headers = dict(record.headers or [])
+            if headers.get(cls.SOURCE_HEADER) == cls.SOURCE_DJANGO:
+                metrics.consumer_messages.inc(topic=record.topic, outcome='skipped')
+                continue
+            try:
+                value = json_codec.loads(record.value)
+            except (ValueError, TypeError) as e:
+                failures.append((record, Unprocessable1CMessage(f"Failed to decode message: {e}")))
+                continue
+            if not isinstance(value, dict):
+                failures.append((record, Unprocessable1CMessage("Message is not a JSON object")))
+                continue
+            decoded.append(decoded_record_type(type(record))(*record._replace(value=value), raw_value=record.value))
+        return decoded, failures
+    
+    @staticmethod
+    def _exclude_processed(records: List[Any]) -> List[Any]:
+        """Отбросить сообщения, уже записанные в ProcessedMessages (один запрос)"""
+        from erp_tools.models import ProcessedMessages
+        
+        if not records:
+            return []
+        
+        offsets_by_partition = {}
+        for record in records:
+            offsets_by_partition.setdefault((record.topic, record.partition), []).append(record.offset)
+        
+        condition = Q()
+        for (topic, partition), offsets in offsets_by_partition.items():
+            condition |= Q(topic=topic, partition=partition, offset__in=offsets)
+        
+        processed = set(
+            ProcessedMessages.objects.filter(condition).values_list('topic', 'partition', 'offset')
+        )
+        if processed:
+            logger.info(f"Skipping {len(processed)} already processed messages")
+        return [record for record in records if (record.topic, record.partition, record.offset) not in processed]
+    
+    @staticmethod
+    def _mark_processed(records: List[Any]):
+        """Записать сообщения в ProcessedMessages"""
+        from erp_tools.models import ProcessedMessages
+        
+        ProcessedMessages.objects.bulk_create(
+            [
+                ProcessedMessages(topic=record.topic, partition=record.partition, offset=record.offset)
+                for record in records
+            ],
+            ignore_conflicts=True,
+        )
+    
+    @staticmethod
+    def prune_processed_messages() -> int:
+        """Удалить записи ProcessedMessages старше KAFKA_PROCESSED_MESSAGES_RETENTION_HOURS"""
+        from erp_tools.models import ProcessedMessages
+        
+        cutoff = timezone.now() - timedelta(hours=settings.KAFKA_PROCESSED_MESSAGES_RETENTION_HOURS)
+        deleted, _ = ProcessedMessages.objects.filter(processed_at__lt=cutoff).delete()
+        if deleted:
+            logger.info(f"Pruned {deleted} processed message records older than {cutoff.isoformat()}")
+        return deleted
+    
+    @classmethod
+    def _process_1c_batch(cls, messages: List[Dict[str, Any]]):
+        """
+        Обработать пачку сообщений от 1С (один message_pack из consumer.poll).
+        
+        Все внешние ключи пачки разрешаются одним in_bulk на модель, изменения
+        применяются к объектам в памяти в порядке сообщений (порядок событий
+        по заявке сохраняется) и записываются bulk_create/bulk_update в одной
+        транзакции. Сигналы при этом не вызываются, события в Kafka не публикуются;
+        в топик состояния измененные заявки попадают через publish_issue_states.
+        
+        Заявка адресуется по issue_id или по external_id через IssueExternalIds;
+        'created' с уже известным external_id обновляет существующую заявку.
+        Ненайденная заявка или некорректное сообщение прерывают пачку
+        исключением: _apply_records повторяет ее по одному сообщению.
+        """
+        from erp_tools.models import Companies, Issues, IssueComments, IssueExternalIds, Users
+        
+        events = [message for message in messages if message.get('source', '1c') != 'django']
+        if not events:
+            return
+        
+        issue_ids = set()
+        external_keys = set()
+        refs = {model: set() for model, key, field in cls._reference_models()}
+        emails = set()
+        for message in events:
+            data = message.get('data', {})
+            if message.get('issue_id'):
+                issue_ids.add(message['issue_id'])
+            external_key = cls._external_key(message)
+            if external_key:
+                external_keys.add(external_key)
+            if message.get('event_type') == 'created':
+                for model, key, field in cls._reference_models():
+                    if data.get(key):
+                        refs[model].add(data[key])
+            elif message.get('event_type') == 'comment_added' and data.get('user_email'):
+                emails.add(data['user_email'])
+        
+        resolved = {model: reference_cache.get_many(model, ids) for model, ids in refs.items()}
+        users_by_email = reference_cache.get_many(Users, emails, field='email')
+        issues = Issues.objects.in_bulk(issue_ids) if issue_ids else {}
+        issues_by_external = {}
+        if external_keys:
+            for mapping in IssueExternalIds.objects.filter(cls._external_keys_filter(external_keys)).select_related('issue'):
+                issue = issues.setdefault(mapping.issue_id, mapping.issue)
+                issues_by_external[(mapping.source, mapping.external_id)] = issue
+        
+        def resolve(model, pk):
+            return resolved[model].get(pk)
+        
+        new_issues = []
+        new_mappings = []
+        new_comments = []
+        dirty_fields = {}
+        
+        for message in events:
+            event_type = message.get('event_type')
+            issue_data = message.get('data', {})
+            external_key = cls._external_key(message)
+            
+            if event_type == 'created':
+                issue = issues_by_external.get(external_key) if external_key else None
+                if issue is None:
+                    issue = cls._build_issue_from_1c(issue_data, resolve)
+                    new_issues.append(issue)
+                    if external_key:
+                        issues_by_external[external_key] = issue
+                        new_mappings.append(
+                            IssueExternalIds(source=external_key[0], external_id=external_key[1], issue=issue)
+                        )
+                    continue
+                fields = cls._apply_1c_upsert(issue, issue_data)
+            elif event_type in ('updated', 'status_changed', 'comment_added'):
+                if message.get('issue_id'):
+                    issue = issues.get(message['issue_id'])
+                elif external_key:
+                    issue = issues_by_external.get(external_key)
+                else:
+                    raise Unprocessable1CMessage(f"No issue_id or external_id in {event_type} from 1C")
+                if issue is None:
+                    # Пачка откатывается и обрабатывается по одному: ошибка относится к своему сообщению
+                    raise Issues.DoesNotExist(
+                        f"Issue {message.get('issue_id') or external_key} not found for {event_type} from 1C"
+                    )
+                
+                if event_type == 'updated':
+                    fields = cls._apply_1c_update(issue, issue_data)
+                elif event_type == 'status_changed':
+                    fields = cls._apply_1c_status(issue, issue_data)
+                else:
+                    comment = IssueComments(issue=issue, comment=issue_data.get('comment', ''))
+                    if issue_data.get('user_email'):
+                        comment.user = users_by_email.get(issue_data['user_email'])
+                    new_comments.append(comment)
+                    continue
+            else:
+                raise Unprocessable1CMessage(f"Unknown event type: {event_type}")
+            
+            # Новые заявки вставляются целиком, отслеживать поля нужно только для существующих
+            if fields and issue.pk:
+                dirty_fields.setdefault(issue.pk, set()).update(fields)
+        
+        # Заявки с одинаковым набором измененных полей обновляются одним запросом
+        update_groups = {}
+        for issue_id, fields in dirty_fields.items():
+            update_groups.setdefault(frozenset(fields), []).append(issues[issue_id])
+        
+        # bulk_create не вызывает Issues.save(): проект заявки заполняется здесь,
+        # компания услуги берется из кэша справочников
+        for issue in new_issues:
+            issue.project_id = issue.derive_project_id(lambda pk: reference_cache.get(Companies, pk))
+        
+        with transaction.atomic():
+            if new_issues:
+                Issues.objects.bulk_create(new_issues)
+            if new_mappings:
+                IssueExternalIds.objects.bulk_create(new_mappings)
+            for fields, objs in update_groups.items():
+                Issues.objects.bulk_update(objs, sorted(fields))
+            if new_comments:
+                IssueComments.objects.bulk_create(new_comments)
+            # bulk_create/bulk_update не вызывают сигналы: состояние публикуется здесь
+            cls.publish_issue_states([issue.pk for issue in new_issues] + list(dirty_fields))
+        
+        logger.info(
+            f"Processed 1C batch of {len(events)} messages: created {len(new_issues)} issues, "
+            f"updated {len(dirty_fields)} issues, added {len(new_comments)} comments"
+        )
+        logger.debug(f"Reference cache stats: {reference_cache.stats()}")
+    
+    @staticmethod
+    def _external_key(message: Dict[str, Any]) -> Optional[tuple]:
+        """Ключ (source, external_id) заявки во внешней системе или None"""
+        external_id = message.get('external_id') or message.get('data', {}).get('external_id')
+        if not external_id:
+            return None
+        return message.get('source', '1c'), str(external_id)
+    
+    @staticmethod
+    def _external_keys_filter(external_keys) -> Q:
+        """Условие выборки IssueExternalIds по набору ключей (source, external_id)"""
+        ids_by_source = {}
+        for source, external_id in external_keys:
+            ids_by_source.setdefault(source, []).append(external_id)
+        condition = Q()
+        for source, external_ids in ids_by_source.items():
+            condition |= Q(source=source, external_id__in=external_ids)
+        return condition
+    
+    @classmethod
+    def _reference_models(cls):
+        """Внешние ключи заявки в сообщениях 1С: (модель, ключ в data, поле Issues)"""
+        from erp_tools.models import Companies, Services, DataBases, Users
+        return (
+            (Companies, 'company_id', 'Companies'),
+            (Services, 'service_id', 'Services'),
+            (DataBases, 'database_id', 'DataBases'),
+            (Users, 'user_id', 'users'),
+        )
+    
+    @classmethod
+    def _build_issue_from_1c(cls, issue_data: Dict[str, Any], resolve: Callable):
+        """Собрать несохраненную заявку из данных 1С; resolve(model, pk) разрешает внешние ключи"""
+        from erp_tools.models import Issues
         
         issue = Issues(
             name=issue_data.get('name', 'Заявка из 1С'),
@@ -210,36 +1374,116 @@ class KafkaService:
             priority=issue_data.get('priority', 'medium'),
         )
         
-        if issue_data.get('company_id'):
-            try:
-                issue.Companies = Companies.objects.get(pk=issue_data['company_id'])
-            except Companies.DoesNotExist:
-                logger.warning(f"Company {issue_data['company_id']} not found")
+        for model, key, field in cls._reference_models():
+            if issue_data.get(key):
+                related = resolve(model, issue_data[key])
+                if related is None:
+                    logger.warning(f"{model.__name__} {issue_data[key]} not found")
+                else:
+                    setattr(issue, field, related)
         
-        if issue_data.get('service_id'):
-            try:
-                issue.Services = Services.objects.get(pk=issue_data['service_id'])
-            except Services.DoesNotExist:
-                logger.warning(f"Service {issue_data['service_id']} not found")
+        return issue
+    
+    @staticmethod
+    def _apply_1c_update(issue, issue_data: Dict[str, Any]) -> List[str]:
+        """Применить к заявке изменения полей из 1С, вернуть список измененных полей"""
+        update_fields = []
+        allowed_fields = {
+            'name': 'name',
+            'content': 'content',
+            'priority': 'priority',
+        }
         
-        if issue_data.get('database_id'):
-            try:
-                issue.DataBases = DataBases.objects.get(pk=issue_data['database_id'])
-            except DataBases.DoesNotExist:
-                logger.warning(f"Database {issue_data['database_id']} not found")
+        for field_1c, field_django in allowed_fields.items():
+            if field_1c in issue_data:
+                setattr(issue, field_django, issue_data[field_1c])
+                update_fields.append(field_django)
         
-        if issue_data.get('user_id'):
-            try:
-                issue.users = Users.objects.get(pk=issue_data['user_id'])
-            except Users.DoesNotExist:
-                logger.warning(f"User {issue_data['user_id']} not found")
+        if 'deadline' in issue_data:
+            deadline_value = issue_data['deadline']
+            if isinstance(deadline_value, str):
+                parsed_deadline = parse_datetime(deadline_value)
+                if parsed_deadline:
+                    issue.deadline = parsed_deadline
+                    update_fields.append('deadline')
+            elif isinstance(deadline_value, datetime):
+                issue.deadline = deadline_value
+                update_fields.append('deadline')
+            elif deadline_value is None:
+                issue.deadline = None
+                update_fields.append('deadline')
         
+        return update_fields
+    
+    @staticmethod
+    def _apply_1c_status(issue, issue_data: Dict[str, Any]) -> List[str]:
+        """Применить к заявке статус из 1С, вернуть список измененных полей"""
+        from erp_tools.models import Issues
+        
+        new_status = issue_data.get('status')
+        if new_status and new_status in dict(Issues.STATUS_CHOICES):
+            old_status = issue.status
+            issue.status = new_status
+            logger.info(f"Updated status of issue {issue.pk} from {old_status} to {new_status} from 1C")
+            return ['status']
+        
+        logger.warning(f"Invalid status {new_status} for issue {issue.pk}")
+        return []
+    
+    @classmethod
+    def _apply_1c_upsert(cls, issue, issue_data: Dict[str, Any]) -> List[str]:
+        """Применить повторное 'created' к уже существующей заявке, вернуть список измененных полей"""
+        update_fields = cls._apply_1c_update(issue, issue_data)
+        if 'status' in issue_data:
+            update_fields += cls._apply_1c_status(issue, issue_data)
+        return update_fields
+    
+    @classmethod
+    def _create_issue_from_1c(cls, issue_data: Dict[str, Any], external_key: Optional[tuple] = None):
+        """Создать заявку из данных 1С (или обновить уже созданную по external_key)"""
+        from erp_tools.models import IssueExternalIds
+        
+        if external_key:
+            mapping = (
+                IssueExternalIds.objects.filter(source=external_key[0], external_id=external_key[1])
+                .select_related('issue')
+                .first()
+            )
+            if mapping:
+                issue = mapping.issue
+                update_fields = cls._apply_1c_upsert(issue, issue_data)
+                if update_fields:
+                    issue._skip_kafka_event = True
+                    issue.save(update_fields=update_fields)
+                logger.info(f"Issue {issue.pk} for external id {external_key} already exists, updated: {update_fields}")
+                return issue
+        
+        issue = cls._build_issue_from_1c(issue_data, reference_cache.get)
         issue._skip_kafka_event = True
-        issue.save()
+        with transaction.atomic():
+            issue.save()
+            if external_key:
+                IssueExternalIds.objects.create(source=external_key[0], external_id=external_key[1], issue=issue)
         
         logger.info(f"Created issue {issue.pk} from 1C")
         return issue
     
+    @staticmethod
+    def _resolve_issue_id(message: Dict[str, Any]) -> Optional[int]:
+        """ID заявки из сообщения: issue_id или поиск по external_id"""
+        from erp_tools.models import IssueExternalIds
+        
+        if message.get('issue_id'):
+            return message['issue_id']
+        external_key = KafkaService._external_key(message)
+        if not external_key:
+            return None
+        return (
+            IssueExternalIds.objects.filter(source=external_key[0], external_id=external_key[1])
+            .values_list('issue_id', flat=True)
+            .first()
+        )
+    
     @classmethod
     def _update_issue_from_1c(cls, issue_id: int, issue_data: Dict[str, Any]):
         """Обновить заявку из данных 1С"""
@@ -248,31 +1492,7 @@ class KafkaService:
         try:
             issue = Issues.objects.get(pk=issue_id)
             
-            update_fields = []
-            allowed_fields = {
-                'name': 'name',
-                'content': 'content',
-                'priority': 'priority',
-            }
-            
-            for field_1c, field_django in allowed_fields.items():
-                if field_1c in issue_data:
-                    setattr(issue, field_django, issue_data[field_1c])
-                    update_fields.append(field_django)
-            
-            if 'deadline' in issue_data:
-                deadline_value = issue_data['deadline']
-                if isinstance(deadline_value, str):
-                    parsed_deadline = parse_datetime(deadline_value)
-                    if parsed_deadline:
-                        issue.deadline = parsed_deadline
-                        update_fields.append('deadline')
-                elif isinstance(deadline_value, datetime):
-                    issue.deadline = deadline_value
-                    update_fields.append('deadline')
-                elif deadline_value is None:
-                    issue.deadline = None
-                    update_fields.append('deadline')
+            update_fields = cls._apply_1c_update(issue, issue_data)
             
             if update_fields:
                 issue._skip_kafka_event = True
@@ -280,7 +1500,7 @@ class KafkaService:
                 logger.info(f"Updated issue {issue_id} from 1C: {update_fields}")
             
         except Issues.DoesNotExist:
-            logger.warning(f"Issue {issue_id} not found for update from 1C")
+            raise Issues.DoesNotExist(f"Issue {issue_id} not found for update from 1C") from None
     
     @classmethod
     def _update_issue_status_from_1c(cls, issue_id: int, issue_data: Dict[str, Any]):
@@ -289,18 +1509,13 @@ class KafkaService:
         
         try:
             issue = Issues.objects.get(pk=issue_id)
-            new_status = issue_data.get('status')
             
-            if new_status and new_status in dict(Issues.STATUS_CHOICES):
-                old_status = issue.status
-                issue.status = new_status
+            update_fields = cls._apply_1c_status(issue, issue_data)
+            if update_fields:
                 issue._skip_kafka_event = True
-                issue.save(update_fields=['status'])
-                logger.info(f"Updated status of issue {issue_id} from {old_status} to {new_status} from 1C")
-            else:
-                logger.warning(f"Invalid status {new_status} for issue {issue_id}")
+                issue.save(update_fields=update_fields)
         except Issues.DoesNotExist:
-            logger.warning(f"Issue {issue_id} not found for status update from 1C")
+            raise Issues.DoesNotExist(f"Issue {issue_id} not found for status update from 1C") from None
     
     @classmethod
     def _add_comment_from_1c(cls, issue_id: int, comment_data: Dict[str, Any]):
@@ -316,9 +1531,8 @@ class KafkaService:
             )
             
             if comment_data.get('user_email'):
-                try:
-                    comment.user = Users.objects.get(email=comment_data['user_email'])
-                except Users.DoesNotExist:
+                comment.user = reference_cache.get(Users, comment_data['user_email'], field='email')
+                if comment.user is None:
                     logger.debug(f"User with email {comment_data['user_email']} not found")
             
             comment._skip_kafka_event = True
@@ -326,15 +1540,62 @@ class KafkaService:
             
             logger.info(f"Added comment to issue {issue_id} from 1C")
         except Issues.DoesNotExist:
-            logger.warning(f"Issue {issue_id} not found for comment from 1C")
+            raise Issues.DoesNotExist(f"Issue {issue_id} not found for comment from 1C") from None
     
     @classmethod
     def close(cls):
-        """Закрыть соединения с Kafka"""
+        """
+        Закрыть клиенты Kafka текущего процесса.
+        
+        Останавливает consumer, дожидается отправки накопленных producer-ом
+        сообщений и сбрасывает на диск локальный буфер. Вызывается при
+        завершении процесса (atexit), в том числе рабочих процессов веб-сервера.
+        """
+        if cls._pid != os.getpid():
+            cls._reset_after_fork()
         cls.stop_consumer()
+        cls.close_producer()
+        cls.close_spool()
+    
+    @classmethod
+    def close_producer(cls, timeout: Optional[float] = None):
+        """Отправить накопленные сообщения и закрыть producer текущего процесса"""
+        producer = cls._producer
+        if producer is None:
+            return
+        cls._producer = None
+        try:
+            producer.flush(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT if timeout is None else timeout)
+        except Exception as e:
+            logger.warning(f"Failed to flush Kafka Producer on close: {e}")
+        producer.close(timeout=timeout)
+        logger.info("Kafka Producer closed")
+    
+    @classmethod
+    def _reset_after_fork(cls):
+        """
+        Забыть клиенты Kafka, унаследованные от родительского процесса.
         
-        if cls._producer:
-            cls._producer.flush()
-            cls._producer.close()
-            cls._producer = None
-            logger.info("Kafka Producer closed")
\ No newline at end of file
+        Сокеты и фоновые потоки producer-а и consumer-а принадлежат родителю:
+        дочерний процесс не закрывает их (это нарушило бы соединения родителя),
+        а создает собственные при первом обращении. Блокировки пересоздаются,
+        так как в момент fork их мог удерживать другой поток.
+        """
+        cls._pid = os.getpid()
+        cls._producer = None
+        cls._consumer = None
+        cls._consumer_thread = None
+        cls._running = False
+        # Буфер родителя остается за ним (flock), у дочернего процесса будет свой каталог
+        cls._spool = None
+        cls._spool_thread = None
+        cls._spool_lock = threading.Lock()
+        cls._circuit = CircuitBreaker(
+            cls._circuit.name,
+            failure_threshold=cls._circuit.failure_threshold,
+            reset_timeout=cls._circuit.reset_timeout,
+        )
+
+
+os.register_at_fork(after_in_child=KafkaService._reset_after_fork)
+atexit.register(KafkaService.close)
\ No newline at end of file
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from erp_tools.models import Issues
+
+
+class Command(BaseCommand):
+    help = (
+        "Заполнить Issues.project у существующих заявок по компании, базе данных или услуге. "
+        "Заявки обновляются диапазонами id, каждая порция - отдельная транзакция; команду "
+        "можно запускать повторно: записываются только заявки с изменившимся проектом"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Количество id заявок, обновляемых одной транзакцией",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        max_id = Issues.objects.aggregate(max_id=Max("id"))["max_id"] or 0
+
+        updated = 0
+        for start in range(0, max_id, chunk_size):
+            with transaction.atomic():
+                # Правило то же, что в Issues.derive_project_id (см. Issues.project_expression)
+                updated += Issues.refresh_projects(Issues.objects.filter(id__gt=start, id__lte=start + chunk_size))
+            self.stdout.write(f"  {min(start + chunk_size, max_id)}/{max_id} ids processed")
+
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} issues"))
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from erp_tools.models import Issues
+from erp_tools.serializers import ISSUE_EVENT_FIELDS, serialize_issue, serialize_issue_delta
+
+
+class Command(BaseCommand):
+    help = (
+        "Микробенчмарк сериализатора событий заявок: время и количество запросов к БД "
+        "на одно событие (ожидается 0 запросов)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=1000, help="Количество заявок из БД")
+        parser.add_argument("--iterations", type=int, default=10, help="Количество проходов")
+
+    def handle(self, *args, **options):
+        issues = list(Issues.objects.order_by("-pk")[: options["count"]])
+        if not issues:
+            raise CommandError("Нет заявок для измерения")
+
+        # Прогрев кэша ContentType: один запрос на тип заявителя за время жизни процесса
+        for issue in issues:
+            serialize_issue(issue)
+
+        iterations = options["iterations"]
+        events = 0
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                for issue in issues:
+                    serialize_issue(issue)
+                    old_values = {attname: getattr(issue, attname) for attname in ISSUE_EVENT_FIELDS}
+                    old_values["priority"] = None
+                    serialize_issue_delta(issue, old_values)
+                    events += 2
+            elapsed = time.perf_counter() - started
+
+        per_event_us = elapsed / events * 1_000_000
+        self.stdout.write(
+            f"Serialized {events} events ({len(issues)} issues x {iterations} iterations, snapshot + delta) "
+            f"in {elapsed:.3f}s: {per_event_us:.1f} us/event, {events / elapsed:.0f} events/s"
+        )
+        self.stdout.write(f"DB queries: {len(queries)} ({len(queries) / events:.4f} per event)")
+        if len(queries):
+            raise CommandError("Сериализатор выполнил запросы к БД")
+        self.stdout.write(self.style.SUCCESS("OK: zero queries per event"))
@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from erp_tools import json_codec
+from erp_tools.kafka_service import KafkaService
+from erp_tools.models import Issues
+from erp_tools.serializers import serialize_issue
+
+
+class Command(BaseCommand):
+    help = (
+        "Микробенчмарк JSON-кодеков на сообщениях о заявках: скорость кодирования "
+        "и разбора для каждого доступного кодека (JSON_CODEC)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=1000, help="Количество заявок из БД")
+        parser.add_argument("--iterations", type=int, default=20, help="Количество проходов")
+
+    def handle(self, *args, **options):
+        issues = list(Issues.objects.order_by("-pk")[: options["count"]])
+        if not issues:
+            raise CommandError("Нет заявок для измерения")
+
+        # Сообщения в том виде, в каком они уходят в Kafka: datetime и Decimal кодирует кодек
+        messages = [
+            KafkaService.build_issue_message("updated", serialize_issue(issue), issue.pk) for issue in issues
+        ]
+        iterations = options["iterations"]
+        total = len(messages) * iterations
+
+        for name in json_codec.CODECS:
+            try:
+                codec = json_codec.get_codec(name)
+            except ValueError as e:
+                self.stdout.write(self.style.WARNING(f"{name}: skipped ({e})"))
+                continue
+
+            started = time.perf_counter()
+            for _ in range(iterations):
+                encoded = [codec.dumps(message) for message in messages]
+            encode_elapsed = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for _ in range(iterations):
+                for data in encoded:
+                    codec.loads(data)
+            decode_elapsed = time.perf_counter() - started
+
+            size = sum(len(data) for data in encoded) * iterations
+            self.stdout.write(
+                f"{name}: encode {total / encode_elapsed:.0f} msg/s ({size / encode_elapsed / 2**20:.1f} MB/s), "
+                f"decode {total / decode_elapsed:.0f} msg/s ({size / decode_elapsed / 2**20:.1f} MB/s), "
+                f"avg size {size / total:.0f} B"
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"Active codec: {json_codec.codec.name}"))
@@ -0,0 +1,61 @@
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from erp_tools.kafka_service import KafkaService
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнить время отправки в Kafka с новым соединением на каждое сообщение (cold) "
+        "и через producer процесса, переиспользуемый между отправками (warm)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=20, help="Количество отправок в каждом режиме")
+        parser.add_argument(
+            "--topic",
+            default=f"{settings.KAFKA_ISSUES_TOPIC}-benchmark",
+            help="Топик для тестовых сообщений (не топик событий заявок, чтобы не задеть потребителей)",
+        )
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        topic = options["topic"]
+        message = KafkaService.build_issue_message("benchmark", {"id": 0}, 0)
+
+        def send():
+            producer = KafkaService.get_producer()
+            producer.send(topic, key="benchmark", value=message).get(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+
+        try:
+            cold = []
+            for _ in range(count):
+                started = time.perf_counter()
+                send()
+                KafkaService.close_producer()
+                cold.append(time.perf_counter() - started)
+
+            send()
+            warm = []
+            for _ in range(count):
+                started = time.perf_counter()
+                send()
+                warm.append(time.perf_counter() - started)
+        except Exception as e:
+            raise CommandError(f"Kafka недоступна: {e}")
+        finally:
+            KafkaService.close()
+
+        for name, timings in (("cold", cold), ("warm", warm)):
+            timings_ms = sorted(t * 1000 for t in timings)
+            p95 = timings_ms[min(len(timings_ms) - 1, int(len(timings_ms) * 0.95))]
+            self.stdout.write(
+                f"{name}: {count} sends, mean {statistics.mean(timings_ms):.2f} ms, "
+                f"median {statistics.median(timings_ms):.2f} ms, p95 {p95:.2f} ms"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f"Connection reuse speedup: {statistics.mean(cold) / statistics.mean(warm):.1f}x")
+        )
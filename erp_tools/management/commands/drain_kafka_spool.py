@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from erp_tools.kafka_service import KafkaService
+
+
+class Command(BaseCommand):
+    help = (
+        "Доставить в Kafka сообщения из локальных буферов KAFKA_SPOOL_DIR, "
+        "оставшиеся от завершившихся процессов"
+    )
+
+    def handle(self, *args, **options):
+        try:
+            delivered = KafkaService.drain_spools()
+        finally:
+            KafkaService.close()
+        self.stdout.write(self.style.SUCCESS(f"Delivered {delivered} spooled messages"))
@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from kafka.admin import KafkaAdminClient, NewTopic
+from kafka.errors import TopicAlreadyExistsError
+
+
+class Command(BaseCommand):
+    help = (
+        "Создать топики Kafka приложения (включая DLQ событий 1С), если их нет. Топик состояния "
+        "KAFKA_ISSUES_STATE_TOPIC создается сжимаемым (cleanup.policy=compact)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--partitions", type=int, default=6, help="Количество партиций новых топиков")
+        parser.add_argument("--replication-factor", type=int, default=1, help="Фактор репликации новых топиков")
+
+    def handle(self, *args, **options):
+        topics = {
+            settings.KAFKA_ISSUES_TOPIC: {},
+            settings.KAFKA_ISSUES_1C_TOPIC: {},
+            settings.KAFKA_ISSUES_1C_DLQ_TOPIC: {},
+        }
+        if settings.KAFKA_ISSUES_STATE_TOPIC:
+            # Сжатие оставляет последнюю запись по каждому ключу, tombstone удаляет ключ
+            topics[settings.KAFKA_ISSUES_STATE_TOPIC] = {
+                "cleanup.policy": "compact",
+                "min.cleanable.dirty.ratio": "0.1",
+                "delete.retention.ms": str(24 * 60 * 60 * 1000),
+            }
+
+        try:
+            admin = KafkaAdminClient(bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS.split(","))
+        except Exception as e:
+            raise CommandError(f"Kafka недоступна: {e}")
+
+        try:
+            for name, topic_configs in topics.items():
+                topic = NewTopic(
+                    name=name,
+                    num_partitions=options["partitions"],
+                    replication_factor=options["replication_factor"],
+                    topic_configs=topic_configs,
+                )
+                try:
+                    admin.create_topics([topic])
+                except TopicAlreadyExistsError:
+                    self.stdout.write(f"Topic {name} already exists")
+                    continue
+                self.stdout.write(self.style.SUCCESS(f"Created topic {name} {topic_configs or ''}".rstrip()))
+        finally:
+            admin.close()
@@ -0,0 +1,112 @@
+import time
+from datetime import datetime, time as dt_time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from erp_tools.kafka_service import KafkaService
+from erp_tools.models import Issues
+from erp_tools.serializers import ISSUE_EVENT_FIELDS, serialize_issue
+
+
+class Command(BaseCommand):
+    help = (
+        "Выгрузить в Kafka снимки всех заявок (событие 'snapshot') для повторной "
+        "синхронизации 1С. Заявки читаются курсором порциями, память ограничена размером порции"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", type=int, help="Только заявки проекта с указанным id")
+        parser.add_argument(
+            "--since",
+            help="Только заявки, созданные начиная с даты (YYYY-MM-DD или ISO 8601)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="Количество заявок, читаемых из БД и подтверждаемых Kafka за один раз",
+        )
+        parser.add_argument(
+            "--topic",
+            default=settings.KAFKA_ISSUES_TOPIC,
+            help="Топик для снимков (по умолчанию KAFKA_ISSUES_TOPIC)",
+        )
+        parser.add_argument(
+            "--state",
+            action="store_true",
+            help="Заполнить сжимаемый топик состояния KAFKA_ISSUES_STATE_TOPIC (вместо --topic)",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        topic = options["topic"]
+        if options["state"]:
+            if not settings.KAFKA_ISSUES_STATE_TOPIC:
+                raise CommandError("KAFKA_ISSUES_STATE_TOPIC не задан")
+            topic = settings.KAFKA_ISSUES_STATE_TOPIC
+
+        queryset = Issues.objects.order_by("pk")
+        if options["project"]:
+            queryset = queryset.filter(project_id=options["project"])
+        if options["since"]:
+            queryset = queryset.filter(date_create__gte=self._parse_since(options["since"]))
+        # Только колонки, входящие в снимок
+        field_names = {field.attname: field.name for field in Issues._meta.concrete_fields}
+        queryset = queryset.only(*[field_names[attname] for attname in ISSUE_EVENT_FIELDS])
+
+        total = queryset.count()
+        self.stdout.write(f"Exporting {total} issues to topic {topic} (chunk size {chunk_size})")
+
+        sent = 0
+        futures = []
+        started = time.monotonic()
+        try:
+            # iterator() на PostgreSQL использует серверный курсор: в памяти не больше chunk_size заявок
+            for issue in queryset.iterator(chunk_size=chunk_size):
+                message = KafkaService.build_issue_message("snapshot", serialize_issue(issue), issue.pk)
+                futures.append(
+                    KafkaService.send_record(
+                        topic, key=str(issue.pk), value=message, headers=KafkaService.SOURCE_HEADERS
+                    )
+                )
+                if len(futures) >= chunk_size:
+                    sent += self._confirm(futures)
+                    futures = []
+                    self._report(sent, total, started)
+            sent += self._confirm(futures)
+        except Exception as e:
+            raise CommandError(f"Export failed after {sent} issues: {e}")
+        finally:
+            KafkaService.close()
+
+        self._report(sent, total, started)
+        self.stdout.write(self.style.SUCCESS(f"Exported {sent} issues"))
+
+    @staticmethod
+    def _parse_since(value: str) -> datetime:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            date = parse_date(value)
+            if date is None:
+                raise CommandError(f"Неверная дата --since: {value}")
+            parsed = datetime.combine(date, dt_time.min)
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    @staticmethod
+    def _confirm(futures) -> int:
+        """Дождаться отправки порции; producer пакетирует и сжимает сообщения сам"""
+        KafkaService.flush(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+        for future in futures:
+            future.get(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+        return len(futures)
+
+    def _report(self, sent: int, total: int, started: float):
+        elapsed = time.monotonic() - started
+        rate = sent / elapsed if elapsed else 0
+        percent = sent * 100 / total if total else 100
+        self.stdout.write(f"  {sent}/{total} ({percent:.1f}%), {rate:.0f} issues/s, {elapsed:.1f}s elapsed")
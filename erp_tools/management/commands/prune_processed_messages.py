@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from erp_tools.kafka_service import KafkaService
+
+
+class Command(BaseCommand):
+    help = (
+        "Удалить устаревшие записи ProcessedMessages "
+        "(старше KAFKA_PROCESSED_MESSAGES_RETENTION_HOURS)"
+    )
+
+    def handle(self, *args, **options):
+        deleted = KafkaService.prune_processed_messages()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} processed message records"))
@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from kafka import KafkaConsumer
+from kafka.structs import OffsetAndMetadata, TopicPartition
+
+from erp_tools.kafka_service import KafkaService
+
+
+class Command(BaseCommand):
+    help = (
+        "Вернуть сообщения из DLQ-топика KAFKA_ISSUES_1C_DLQ_TOPIC в исходный топик после "
+        "устранения причины ошибки. Возвращенные сообщения фиксируются группой "
+        "<KAFKA_CONSUMER_GROUP>-dlq-redrive и при следующем запуске не читаются"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, help="Вернуть не больше указанного количества сообщений")
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Только вывести сообщения и причины ошибок, ничего не отправлять и не фиксировать",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=5.0,
+            help="Завершить, если новых сообщений в DLQ нет указанное количество секунд",
+        )
+
+    def handle(self, *args, **options):
+        limit = options["limit"]
+        dry_run = options["dry_run"]
+        try:
+            consumer = KafkaConsumer(
+                settings.KAFKA_ISSUES_1C_DLQ_TOPIC,
+                bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS.split(","),
+                group_id=f"{settings.KAFKA_CONSUMER_GROUP}-dlq-redrive",
+                key_deserializer=lambda k: k.decode("utf-8") if k else None,
+                auto_offset_reset="earliest",
+                enable_auto_commit=False,
+                consumer_timeout_ms=int(options["timeout"] * 1000),
+            )
+        except Exception as e:
+            raise CommandError(f"Kafka недоступна: {e}")
+
+        redriven = 0
+        futures = []
+        offsets = {}
+        try:
+            for record in consumer:
+                headers = {key: value.decode("utf-8", "replace") for key, value in record.headers or []}
+                topic = headers.get("x-original-topic") or settings.KAFKA_ISSUES_1C_TOPIC
+                self.stdout.write(
+                    f"{record.topic}[{record.partition}]@{record.offset} -> {topic}, "
+                    f"attempts {headers.get('x-attempts', '?')}, failed at {headers.get('x-failed-at', '?')}: "
+                    f"{headers.get('x-error-type', '')}: {headers.get('x-error', '')}"
+                )
+                if not dry_run:
+                    # Исходные заголовки без описания ошибки; значение пересылается без перекодирования
+                    original_headers = [(key, value) for key, value in record.headers or [] if not key.startswith("x-")]
+                    futures.append(
+                        KafkaService.send_record(topic, key=record.key, value=record.value, headers=original_headers)
+                    )
+                    offsets[TopicPartition(record.topic, record.partition)] = record.offset + 1
+                redriven += 1
+                if limit and redriven >= limit:
+                    break
+
+            if futures:
+                # Offset-ы DLQ фиксируются только после подтверждения отправки всех сообщений
+                KafkaService.flush(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+                for future in futures:
+                    future.get(timeout=settings.KAFKA_OUTBOX_SEND_TIMEOUT)
+                consumer.commit({tp: OffsetAndMetadata(offset, "", -1) for tp, offset in offsets.items()})
+        except Exception as e:
+            raise CommandError(f"Redrive failed after {redriven} messages: {e}")
+        finally:
+            consumer.close()
+            KafkaService.close()
+
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(f"Found {redriven} messages in {settings.KAFKA_ISSUES_1C_DLQ_TOPIC}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Redrove {redriven} messages"))
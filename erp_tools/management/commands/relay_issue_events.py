@@ -0,0 +1,73 @@
+import logging
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from erp_tools import metrics
+from erp_tools.kafka_service import KafkaService
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Доставить события заявок из таблицы OutboxEvents в Kafka (KAFKA_ISSUES_TOPIC)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.KAFKA_OUTBOX_BATCH_SIZE,
+            help="Максимальное количество событий в одной пачке",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=settings.KAFKA_OUTBOX_POLL_INTERVAL,
+            help="Пауза в секундах, когда outbox пуст",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Отправить все накопленные события и завершиться",
+        )
+        parser.add_argument("--metrics-port", type=int, help="Отдавать метрики Prometheus на указанном порту")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        interval = options["interval"]
+        self._running = True
+
+        def stop(signum, frame):
+            self._running = False
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        if options["metrics_port"]:
+            metrics.start_http_server(options["metrics_port"])
+
+        self.stdout.write(f"Outbox relay started (batch_size={batch_size}, interval={interval}s)")
+        total = 0
+        try:
+            while self._running:
+                try:
+                    # Буферы прямой отправки, оставшиеся от завершившихся процессов
+                    KafkaService.drain_spools()
+                    relayed = KafkaService.relay_outbox(batch_size)
+                except Exception as e:
+                    logger.error(f"Error relaying outbox events: {e}", exc_info=True)
+                    relayed = 0
+                    if options["once"]:
+                        raise
+                total += relayed
+
+                if relayed < batch_size:
+                    if options["once"]:
+                        break
+                    time.sleep(interval)
+        finally:
+            KafkaService.close()
+
+        self.stdout.write(self.style.SUCCESS(f"Outbox relay stopped, events relayed: {total}"))
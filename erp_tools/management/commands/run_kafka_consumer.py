@@ -0,0 +1,99 @@
+import logging
+import multiprocessing
+import signal
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def _run_worker(index: int, metrics_port: Optional[int] = None):
+    """Точка входа процесса-воркера: один KafkaConsumer в общей consumer group"""
+    import django
+
+    django.setup()
+
+    from erp_tools import metrics
+    from erp_tools.kafka_service import KafkaService
+
+    if metrics_port:
+        # Каждый воркер отдает свои метрики на отдельном порту
+        metrics.start_http_server(metrics_port + index)
+
+    def stop(signum, frame):
+        KafkaService.stop_consumer()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info(f"Kafka consumer worker #{index} started")
+    KafkaService.run_consumer()
+
+
+class Command(BaseCommand):
+    help = (
+        "Запустить пул процессов Kafka Consumer для событий 1С. "
+        "Партиции топиков распределяются между воркерами средствами consumer group."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.KAFKA_CONSUMER_WORKERS,
+            help="Количество процессов-воркеров (не имеет смысла больше числа партиций)",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            help="Отдавать метрики Prometheus: воркер N слушает порт metrics-port + N",
+        )
+
+    def handle(self, *args, **options):
+        workers = max(1, options["workers"])
+        self._running = True
+
+        def stop(signum, frame):
+            self._running = False
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        # Соединения с БД не должны наследоваться дочерними процессами
+        connections.close_all()
+
+        metrics_port = options["metrics_port"]
+        processes = {index: self._spawn(index, metrics_port) for index in range(workers)}
+        self.stdout.write(f"Started {workers} Kafka consumer worker(s)")
+
+        try:
+            while self._running:
+                for index, process in list(processes.items()):
+                    if not process.is_alive():
+                        logger.warning(
+                            f"Kafka consumer worker #{index} exited with code {process.exitcode}, restarting"
+                        )
+                        processes[index] = self._spawn(index, metrics_port)
+                time.sleep(1)
+        finally:
+            for process in processes.values():
+                if process.is_alive():
+                    process.terminate()
+            for process in processes.values():
+                process.join(timeout=30)
+
+        self.stdout.write(self.style.SUCCESS("Kafka consumer workers stopped"))
+
+    @staticmethod
+    def _spawn(index: int, metrics_port: Optional[int] = None) -> multiprocessing.Process:
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(index, metrics_port),
+            name=f"kafka-consumer-{index}",
+        )
+        process.start()
+        return process
@@ -0,0 +1,268 @@
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Формат ответа Prometheus (text exposition format 0.0.4)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы корзин гистограмм задержек, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    """Метрика с набором меток; значения хранятся по кортежу значений меток"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, object] = {}
+
+    def _key(self, labels: Dict[str, object]) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric {self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def reset_after_fork(self):
+        """Дочерний процесс начинает с нуля: значения родителя ему не принадлежат"""
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self._samples():
+            lines.append(f'{name}{labels} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in items]
+
+
+class Gauge(_Metric):
+    """Текущее значение (отставание, скорость обработки)"""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in items]
+
+
+class Histogram(_Metric):
+    """Распределение длительностей по корзинам (кумулятивные _bucket, _sum, _count)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счетчики корзин (последняя - +Inf) и сумма
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            index = len(self.buckets)
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = position
+                    break
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Измерить длительность блока with"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1])) for key, state in self._values.items())
+        samples = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labels + ('le',), key + (_format_value(bound),))
+                samples.append((f'{self.name}_bucket', bucket_labels, cumulative))
+            labels = _format_labels(self.labels, key)
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    """Метрики процесса; render() - ответ для Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def reset_after_fork(self):
+        for metric in self._metrics.values():
+            metric.reset_after_fork()
+
+
+registry = Registry()
+
+# Consumer событий 1С
+consumer_messages = registry.counter(
+    'kafka_consumer_messages_total',
+    'Messages read by the 1C consumer by outcome (applied, skipped, retried, dead_lettered)',
+    ('topic', 'outcome'),
+)
+consumer_throughput = registry.gauge(
+    'kafka_consumer_messages_per_second',
+    'Messages read by the 1C consumer per second over the last metrics interval',
+)
+consumer_lag = registry.gauge(
+    'kafka_consumer_lag',
+    'Messages between the partition high watermark and the last offset committed by this process',
+    ('topic', 'partition'),
+)
+consumer_apply_seconds = registry.histogram(
+    'kafka_consumer_apply_seconds',
+    'Time to apply one 1C message by event type (batch time divided by batch size in batch mode)',
+    ('event_type',),
+)
+consumer_retry_pending = registry.gauge(
+    'kafka_consumer_retry_pending',
+    'Failed 1C messages waiting for a retry',
+)
+
+# Кэш справочников consumer-а (reference_cache)
+reference_cache_lookups = registry.counter(
+    'reference_cache_lookups_total',
+    'Reference cache lookups by model and outcome (hit, miss)',
+    ('model', 'outcome'),
+)
+reference_cache_evictions = registry.counter(
+    'reference_cache_evictions_total',
+    'Reference cache entries evicted to stay within KAFKA_REFERENCE_CACHE_SIZE',
+)
+reference_cache_size = registry.gauge(
+    'reference_cache_entries',
+    'Entries in the reference cache',
+)
+
+# Producer
+producer_send_seconds = registry.histogram(
+    'kafka_producer_send_seconds',
+    'Time from producer.send() to broker acknowledgement',
+    ('topic',),
+)
+producer_send_failures = registry.counter(
+    'kafka_producer_send_failures_total',
+    'Messages the broker did not acknowledge',
+    ('topic',),
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics request: {format % args}")
+
+
+def start_http_server(port: int, address: str = '') -> Optional[ThreadingHTTPServer]:
+    """
+    Отдавать метрики процесса по HTTP в фоновом потоке.
+
+    Для процессов без веб-сервера (run_kafka_consumer, relay_issue_events);
+    в веб-процессе метрики отдает представление metrics_view (каждый рабочий
+    процесс веб-сервера - свои).
+    """
+    try:
+        server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Failed to start metrics server on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=f'metrics-{port}', daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
+    return server
+
+
+os.register_at_fork(after_in_child=registry.reset_after_fork)
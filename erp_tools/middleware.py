@@ -0,0 +1,29 @@
+from django.utils.functional import SimpleLazyObject
+
+from erp_tools.profile_cache import load_profile_access
+
+
+class ProfileMiddleware:
+    """
+    Ленивые request.access (ProfileAccess) и request.profile (Users) для
+    авторизованного пользователя.
+
+    Профиль загружается при первом обращении и не больше одного раза за
+    запрос, обычно из кэша (см. load_profile_access). Для анонимного
+    пользователя оба атрибута - None. Подключается после AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # request.user читается при обращении: login() в запросе меняет пользователя
+        request.access = SimpleLazyObject(lambda: self._load(request))
+        request.profile = SimpleLazyObject(lambda: getattr(request.access, 'profile', None))
+        return self.get_response(request)
+
+    @staticmethod
+    def _load(request):
+        if not request.user.is_authenticated:
+            return None
+        return load_profile_access(request.user)
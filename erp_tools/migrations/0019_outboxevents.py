@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('erp_tools', '0018_change_applicant_to_generic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvents',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(max_length=50, verbose_name='Тип события')),
+                ('issue_id', models.BigIntegerField(db_index=True, verbose_name='ID заявки')),
+                ('payload', models.JSONField(default=dict, verbose_name='Сообщение')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Попыток отправки')),
+                ('last_error', models.TextField(blank=True, null=True, verbose_name='Последняя ошибка')),
+                ('date_create', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Исходящее событие',
+                'verbose_name_plural': 'Исходящие события',
+                'ordering': ['id'],
+            },
+        ),
+    ]
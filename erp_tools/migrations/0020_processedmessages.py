@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('erp_tools', '0019_outboxevents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedMessages',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic', models.CharField(max_length=255, verbose_name='Топик')),
+                ('partition', models.IntegerField(verbose_name='Партиция')),
+                ('offset', models.BigIntegerField(verbose_name='Offset')),
+                ('processed_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Дата обработки')),
+            ],
+            options={
+                'verbose_name': 'Обработанное сообщение',
+                'verbose_name_plural': 'Обработанные сообщения',
+                'constraints': [models.UniqueConstraint(fields=('topic', 'partition', 'offset'), name='processed_message_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('erp_tools', '0020_processedmessages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IssueExternalIds',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(default='1c', max_length=50, verbose_name='Внешняя система')),
+                ('external_id', models.CharField(max_length=255, verbose_name='Внешний ID')),
+                ('date_create', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('issue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='external_ids', to='erp_tools.issues', verbose_name='Задача')),
+            ],
+            options={
+                'verbose_name': 'Внешний ID задачи',
+                'verbose_name_plural': 'Внешние ID задач',
+                'constraints': [models.UniqueConstraint(fields=('source', 'external_id'), name='issue_external_id_unique')],
+            },
+        ),
+    ]
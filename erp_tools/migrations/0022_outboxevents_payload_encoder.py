@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:05
+
+import erp_tools.json_codec
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('erp_tools', '0021_issueexternalids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboxevents',
+            name='payload',
+            field=models.JSONField(default=dict, encoder=erp_tools.json_codec.CodecJSONEncoder, verbose_name='Сообщение'),
+        ),
+    ]
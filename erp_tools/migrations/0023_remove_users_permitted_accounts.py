@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:19
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('erp_tools', '0022_outboxevents_payload_encoder'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='users',
+            name='permitted_accounts',
+        ),
+    ]
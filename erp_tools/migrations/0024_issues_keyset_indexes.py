@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('erp_tools', '0023_remove_users_permitted_accounts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='issues',
+            index=models.Index(fields=['date_create', 'id'], name='issue_date_create_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issues',
+            index=models.Index(fields=['name', 'id'], name='issue_name_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issues',
+            index=models.Index(fields=['status', 'id'], name='issue_status_id_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('erp_tools', '0024_issues_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='issues',
+            index=models.Index(fields=['status', 'date_create', 'id'], name='issue_status_date_create_idx'),
+        ),
+    ]
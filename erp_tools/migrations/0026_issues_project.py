@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('erp_tools', '0025_issues_kanban_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issues',
+            name='project',
+            field=models.ForeignKey(blank=True, db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='issues', to='erp_tools.projects', verbose_name='Проект'),
+        ),
+        migrations.AddIndex(
+            model_name='issues',
+            index=models.Index(fields=['project', 'date_create', 'id'], name='issue_project_date_create_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issues',
+            index=models.Index(fields=['project', 'status', 'date_create', 'id'], name='issue_project_status_idx'),
+        ),
+    ]
@@ -1,9 +1,40 @@
 from django.conf import settings
 from django.db import models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.forms import ValidationError
 from django.utils.text import slugify
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from erp_tools.json_codec import CodecJSONEncoder
+
+
+class LoadedValuesMixin:
+    """
+    Снимок значений полей, прочитанных из БД или записанных последним save():
+    старые значения доступны в сигналах без повторного запроса в pre_save.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    @property
+    def loaded_values(self):
+        """Значения полей (по attname), прочитанные из БД или сохраненные последним save()"""
+        return getattr(self, '_loaded_values', {})
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            attnames = [self._meta.get_field(name).attname for name in update_fields]
+        else:
+            deferred = self.get_deferred_fields()
+            attnames = [field.attname for field in self._meta.concrete_fields if field.attname not in deferred]
+        self._loaded_values = {**self.loaded_values, **{attname: getattr(self, attname) for attname in attnames}}
 
 
 class Users(models.Model):
@@ -28,7 +59,6 @@ class Users(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     owner = models.ForeignKey('Accounts', on_delete=models.SET_NULL, null=True, blank=True)
-    permitted_accounts = models.JSONField(default=list, blank=True)
 
     @property
     def is_admin(self):
@@ -124,7 +154,7 @@ class ProjectTeams(models.Model):
 
 
 
-class Companies(models.Model):
+class Companies(LoadedValuesMixin, models.Model):
     name = models.CharField(max_length=255, verbose_name='Название компании')
     owner = models.ForeignKey(Projects, on_delete=models.CASCADE, related_name='companies',null=True,blank=True, verbose_name='Проект')
     tax_code = models.CharField(max_length=255, verbose_name='ИНН')
@@ -175,7 +205,7 @@ class ClientTeams(models.Model):
         return f"{self.company.name} - {self.role or 'Участник'}"
 
 
-class DataBases(models.Model):
+class DataBases(LoadedValuesMixin, models.Model):
     content = models.TextField(blank=True, null=True, verbose_name='Содержание')
     path = models.CharField(max_length=255, verbose_name='Путь')
     server = models.CharField(max_length=255, verbose_name='Сервер')
@@ -193,7 +223,7 @@ class DataBases(models.Model):
         return f"{self.path} - {self.server}"
 
 
-class Services(models.Model):
+class Services(LoadedValuesMixin, models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Цена')
     time_check = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Время проверки')
     time_dead_line = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Время дедлайна')
@@ -237,7 +267,7 @@ class Sprints(models.Model):
         return self.name or f"Sprint #{self.pk}"
 
 
-class Issues(models.Model):
+class Issues(LoadedValuesMixin, models.Model):
     name = models.CharField(max_length=255, verbose_name='Название')
     content = models.TextField(blank=True, null=True, verbose_name='Содержание')
     Companies = models.ForeignKey(Companies, on_delete=models.CASCADE, related_name='issues',null=True,blank=True, verbose_name='Компания')
@@ -284,6 +314,19 @@ class Issues(models.Model):
     sla_exec = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, verbose_name='СЛА выполнения')
     sla_check = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, verbose_name='СЛА проверки')
     sla_deadline = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, verbose_name='СЛА дедлайна')
+    # Проект первой связи с проектом (компания, база данных, услуга) для фильтра по проекту
+    # без OR по трем join-ам. Заполняется в save() и сигналами при смене проекта связей;
+    # отдельный индекс не нужен - поле первое в составных индексах ниже
+    project = models.ForeignKey(
+        Projects,
+        on_delete=models.SET_NULL,
+        related_name='issues',
+        null=True,
+        blank=True,
+        editable=False,
+        db_index=False,
+        verbose_name='Проект',
+    )
     
     
     class Meta:
@@ -291,10 +334,89 @@ class Issues(models.Model):
         verbose_name = 'Задача'
         verbose_name_plural = 'Задачи'
         ordering = ['-date_create']
+        # Keyset-пагинация списка заявок: по индексу на каждую колонку сортировки (см. pagination.py)
+        indexes = [
+            models.Index(fields=['date_create', 'id'], name='issue_date_create_id_idx'),
+            models.Index(fields=['name', 'id'], name='issue_name_id_idx'),
+            models.Index(fields=['status', 'id'], name='issue_status_id_idx'),
+            # Колонки канбан-доски: карточки статуса по дате создания
+            models.Index(fields=['status', 'date_create', 'id'], name='issue_status_date_create_idx'),
+            # То же внутри проекта
+            models.Index(fields=['project', 'date_create', 'id'], name='issue_project_date_create_idx'),
+            models.Index(fields=['project', 'status', 'date_create', 'id'], name='issue_project_status_idx'),
+        ]
+
+    # Связи, по которым определяется проект заявки, в порядке приоритета (см. derive_project_id)
+    PROJECT_SOURCE_FIELDS = ('Companies', 'DataBases', 'Services')
 
     def __str__(self):
         return self.name or f"Issue #{self.pk}"
 
+    def derive_project_id(self, resolve_company=None):
+        """
+        Проект заявки: проект компании, иначе базы данных, иначе компании услуги.
+
+        У заявки один проект - первый по этому приоритету; связь без проекта
+        пропускается. Если компания и база данных заявки относятся к разным
+        проектам, заявка попадает только в проект компании. resolve_company(pk) -
+        получение компании услуги без запроса (кэш справочников).
+        """
+        if self.Companies_id and self.Companies.owner_id:
+            return self.Companies.owner_id
+        if self.DataBases_id and self.DataBases.owner_id:
+            return self.DataBases.owner_id
+        if self.Services_id and self.Services.company_id:
+            company_id = self.Services.company_id
+            company = resolve_company(company_id) if resolve_company else self.Services.company
+            return company.owner_id if company else None
+        return None
+
+    @staticmethod
+    def project_expression():
+        """То же правило, что derive_project_id, SQL-выражением для UPDATE заявок"""
+        return Coalesce(
+            Subquery(Companies.objects.filter(pk=OuterRef('Companies_id')).order_by().values('owner_id')[:1]),
+            Subquery(DataBases.objects.filter(pk=OuterRef('DataBases_id')).order_by().values('owner_id')[:1]),
+            Subquery(Services.objects.filter(pk=OuterRef('Services_id')).order_by().values('company__owner_id')[:1]),
+        )
+
+    @classmethod
+    def refresh_projects(cls, issues) -> int:
+        """
+        Пересчитать проект заявок queryset-а issues одним UPDATE.
+
+        Пишутся только строки, у которых проект изменился; возвращает их количество.
+        """
+        project = cls.project_expression()
+        changed = issues.annotate(new_project=project).filter(
+            models.Q(new_project__isnull=True, project__isnull=False)
+            | models.Q(new_project__isnull=False, project__isnull=True)
+            | (models.Q(new_project__isnull=False) & ~models.Q(project=models.F('new_project')))
+        )
+        return cls.objects.filter(pk__in=changed.values('pk')).update(project_id=project)
+
+    def _project_source_changed(self, update_fields) -> bool:
+        if update_fields is not None and not {
+            name for name in update_fields if name.removesuffix('_id') in self.PROJECT_SOURCE_FIELDS
+        }:
+            return False
+        if self._state.adding:
+            return True
+        # Незагруженные (отложенные) связи не сравниваются: их значение не менялось
+        loaded = self.loaded_values
+        return any(
+            f"{name}_id" in loaded and loaded[f"{name}_id"] != getattr(self, f"{name}_id")
+            for name in self.PROJECT_SOURCE_FIELDS
+        )
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if self._project_source_changed(update_fields):
+            self.project_id = self.derive_project_id()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'project'}
+        super().save(*args, **kwargs)
+
 
 class IssueComments(models.Model):
     issue = models.ForeignKey(
@@ -325,3 +447,63 @@ class IssueComments(models.Model):
     def __str__(self):
         return f"Comment #{self.pk} - {self.comment}"
 
+
+
+class IssueExternalIds(models.Model):
+    """Соответствие идентификатора заявки во внешней системе (1С) заявке Django"""
+
+    source = models.CharField(max_length=50, default='1c', verbose_name='Внешняя система')
+    external_id = models.CharField(max_length=255, verbose_name='Внешний ID')
+    issue = models.ForeignKey(Issues, on_delete=models.CASCADE, related_name='external_ids', verbose_name='Задача')
+    date_create = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+
+    class Meta:
+        app_label = 'erp_tools'
+        verbose_name = 'Внешний ID задачи'
+        verbose_name_plural = 'Внешние ID задач'
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'external_id'], name='issue_external_id_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.source}:{self.external_id} -> Issue #{self.issue_id}"
+
+
+class OutboxEvents(models.Model):
+    """Исходящие события заявок, ожидающие отправки в Kafka (transactional outbox)"""
+
+    event_type = models.CharField(max_length=50, verbose_name='Тип события')
+    issue_id = models.BigIntegerField(db_index=True, verbose_name='ID заявки')
+    payload = models.JSONField(default=dict, encoder=CodecJSONEncoder, verbose_name='Сообщение')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Попыток отправки')
+    last_error = models.TextField(blank=True, null=True, verbose_name='Последняя ошибка')
+    date_create = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+
+    class Meta:
+        app_label = 'erp_tools'
+        verbose_name = 'Исходящее событие'
+        verbose_name_plural = 'Исходящие события'
+        ordering = ['id']
+
+    def __str__(self):
+        return f"Outbox #{self.pk} - {self.event_type} for issue {self.issue_id}"
+
+
+class ProcessedMessages(models.Model):
+    """Обработанные consumer-ом сообщения Kafka: защита от повторной обработки при replay"""
+
+    topic = models.CharField(max_length=255, verbose_name='Топик')
+    partition = models.IntegerField(verbose_name='Партиция')
+    offset = models.BigIntegerField(verbose_name='Offset')
+    processed_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Дата обработки')
+
+    class Meta:
+        app_label = 'erp_tools'
+        verbose_name = 'Обработанное сообщение'
+        verbose_name_plural = 'Обработанные сообщения'
+        constraints = [
+            models.UniqueConstraint(fields=['topic', 'partition', 'offset'], name='processed_message_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.topic}[{self.partition}]@{self.offset}"
@@ -0,0 +1,98 @@
+import base64
+import datetime
+import json
+from typing import Any, List, Optional, Tuple
+
+from django.db.models import Q, QuerySet
+
+# Колонки списка заявок, по которым разрешена сортировка. Для каждой есть
+# составной индекс (колонка, id) в Issues.Meta.indexes: страница читается
+# диапазоном индекса независимо от ее номера
+ISSUE_SORT_FIELDS = ('date_create', 'name', 'status')
+DEFAULT_ISSUE_SORT = '-date_create'
+
+
+class InvalidCursor(ValueError):
+    """Курсор поврежден или выдан для другой сортировки"""
+
+
+class KeysetPage:
+    """Страница результатов: объекты и курсор следующей страницы (None - страница последняя)"""
+
+    def __init__(self, items: List[Any], next_cursor: Optional[str], sort: str):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.sort = sort
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+
+def parse_sort(value: Optional[str], allowed=ISSUE_SORT_FIELDS, default: str = DEFAULT_ISSUE_SORT) -> str:
+    """Параметр sort из запроса ("поле" или "-поле"); неизвестное поле заменяется сортировкой по умолчанию"""
+    if value and value.lstrip('-') in allowed:
+        return value
+    return default
+
+
+def encode_cursor(sort: str, value: Any, pk: int) -> str:
+    """Непрозрачный курсор: сортировка и ключ (значение колонки, id) последней строки страницы"""
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, pk], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: str) -> Tuple[Any, int]:
+    """
+    Ключ (значение колонки, id) из курсора.
+
+    Курсор приходит от клиента, поэтому проверяются типы: все колонки сортировки
+    NOT NULL и хранятся в курсоре строкой (дата - в ISO 8601 с часовым поясом).
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, value, pk = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {e}")
+    if cursor_sort != sort:
+        raise InvalidCursor(f"Cursor was issued for sort {cursor_sort!r}, not {sort!r}")
+    if not isinstance(pk, int) or isinstance(pk, bool):
+        raise InvalidCursor(f"Invalid cursor id: {pk!r}")
+    if not isinstance(value, str):
+        raise InvalidCursor(f"Invalid cursor value for {sort.lstrip('-')}: {value!r}")
+    if sort.lstrip('-') == 'date_create':
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError as e:
+            raise InvalidCursor(f"Invalid cursor: {e}")
+        if value.tzinfo is None:
+            raise InvalidCursor(f"Cursor date has no time zone: {value}")
+    return value, pk
+
+
+def keyset_paginate(queryset: QuerySet, sort: str, cursor: Optional[str], page_size: int) -> KeysetPage:
+    """
+    Страница queryset после курсора в порядке (sort, id).
+
+    Вместо OFFSET строки отбираются условием "ключ после ключа последней строки
+    предыдущей страницы", поэтому стоимость запроса не зависит от того, как далеко
+    пролистан список. id делает порядок однозначным при равных значениях колонки.
+    Читается page_size + 1 строка: лишняя показывает, что есть следующая страница.
+    """
+    field = sort.lstrip('-')
+    descending = sort.startswith('-')
+    queryset = queryset.order_by(f"-{field}", "-id") if descending else queryset.order_by(field, "id")
+    if cursor:
+        value, pk = decode_cursor(cursor, sort)
+        op = 'lt' if descending else 'gt'
+        queryset = queryset.filter(Q(**{f"{field}__{op}": value}) | Q(**{field: value, f"id__{op}": pk}))
+
+    items = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = encode_cursor(sort, getattr(last, field), last.pk)
+    return KeysetPage(items, next_cursor, sort)
@@ -0,0 +1,125 @@
+import logging
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+
+logger = logging.getLogger(__name__)
+
+# Ключи в общем кэше Django: профиль пользователя системы и счетчик изменений проектов/команд
+PROFILE_CACHE_KEY = 'erp_tools:profile:{auth_user_id}'
+GENERATION_CACHE_KEY = 'erp_tools:profile:generation'
+
+
+class ProfileAccess:
+    """
+    Профиль (Users) текущего пользователя и вычисленные по нему права.
+
+    is_admin - роль admin или суперпользователь, managed_project_ids - проекты,
+    где пользователь менеджер, team_roles - роли в командах проектов
+    {id проекта: frozenset ролей}.
+    """
+
+    def __init__(
+        self,
+        profile,
+        is_admin: bool,
+        managed_project_ids: FrozenSet[int],
+        team_roles: Dict[int, FrozenSet[str]],
+        generation: Optional[int] = None,
+    ):
+        self.profile = profile
+        self.is_admin = is_admin
+        self.managed_project_ids = managed_project_ids
+        self.team_roles = team_roles
+        self.generation = generation
+
+    def has_team_role(self, project_id: Optional[int], roles) -> bool:
+        """Есть ли у пользователя в команде проекта одна из ролей roles"""
+        return bool(self.team_roles.get(project_id, frozenset()) & set(roles))
+
+
+def load_profile_access(auth_user) -> ProfileAccess:
+    """
+    Профиль и права пользователя: из кэша или из БД с созданием профиля.
+
+    Запись кэша и счетчик изменений проектов читаются одним обращением к кэшу.
+    Запись удаляется при сохранении профиля или пользователя системы
+    (invalidate_profile), изменение проектов и команд делает устаревшими все
+    записи (bump_generation). Без общего кэша (см. is_cache_shared) профиль
+    читается из БД в каждом запросе.
+    """
+    if not is_cache_shared():
+        return _build_profile_access(auth_user, None)
+
+    key = PROFILE_CACHE_KEY.format(auth_user_id=auth_user.pk)
+    try:
+        cached = cache.get_many([key, GENERATION_CACHE_KEY])
+    except Exception as e:
+        logger.warning(f"Failed to read profile cache: {e}")
+        cached = {}
+    generation = cached.get(GENERATION_CACHE_KEY)
+    access = cached.get(key)
+    if access is not None and access.generation == generation:
+        return access
+
+    access = _build_profile_access(auth_user, generation)
+    try:
+        cache.set(key, access, timeout=settings.PROFILE_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"Failed to store profile in cache: {e}")
+    return access
+
+
+def is_cache_shared() -> bool:
+    """
+    Общий ли кэш у процессов приложения.
+
+    LocMemCache (без REDIS_URL) у каждого процесса свой: сброс записи в одном
+    рабочем процессе не дошел бы до остальных, и они до PROFILE_CACHE_TTL
+    использовали бы устаревшие права.
+    """
+    return not isinstance(caches['default'], LocMemCache)
+
+
+def _build_profile_access(auth_user, generation: Optional[int]) -> ProfileAccess:
+    from erp_tools.models import Projects, ProjectTeams, Users
+
+    profile, _ = Users.objects.get_or_create(
+        auth_user=auth_user,
+        defaults={
+            "name": auth_user.username,
+            "email": auth_user.email,
+            "role": "user",
+        },
+    )
+    team_roles: Dict[int, set] = {}
+    for project_id, role in ProjectTeams.objects.filter(user=profile, owner__isnull=False).values_list("owner_id", "role"):
+        team_roles.setdefault(project_id, set()).add(role)
+    return ProfileAccess(
+        profile,
+        is_admin=profile.role == "admin" or auth_user.is_superuser,
+        managed_project_ids=frozenset(Projects.objects.filter(manager=profile).values_list("id", flat=True)),
+        team_roles={project_id: frozenset(roles) for project_id, roles in team_roles.items()},
+        generation=generation,
+    )
+
+
+def invalidate_profile(auth_user_id: Optional[int]):
+    """Сбросить кэш профиля пользователя системы"""
+    if auth_user_id is None:
+        return
+    try:
+        cache.delete(PROFILE_CACHE_KEY.format(auth_user_id=auth_user_id))
+    except Exception as e:
+        logger.warning(f"Failed to invalidate profile cache: {e}")
+
+
+def bump_generation():
+    """Сделать устаревшими кэшированные права всех пользователей (изменились проекты или команды)"""
+    try:
+        if not cache.add(GENERATION_CACHE_KEY, 1, timeout=None):
+            cache.incr(GENERATION_CACHE_KEY)
+    except Exception as e:
+        logger.warning(f"Failed to bump profile cache generation: {e}")
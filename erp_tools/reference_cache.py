@@ -0,0 +1,153 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+
+from erp_tools import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ключ в общем кэше Django: счетчик изменений справочников для сброса кэша в других процессах
+GENERATION_CACHE_KEY = 'erp_tools:reference_cache:generation'
+
+
+class ReferenceCache:
+    """
+    Ограниченный LRU-кэш справочников (Companies, Services, DataBases, Users) с TTL.
+
+    Используется consumer-ом 1С для разрешения внешних ключей без запроса к БД
+    на каждое сообщение. Записи вытесняются при превышении max_size и устаревают
+    через ttl секунд. Сигналы моделей вызывают invalidate(); изменения из других
+    процессов подхватываются через sync() по счетчику в общем кэше Django.
+    Попадания, промахи и вытеснения учитываются в метриках reference_cache_*.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model, key, field: str = 'pk'):
+        """Получить объект model по значению field или None, если он не найден"""
+        return self.get_many(model, [key], field).get(key)
+
+    def get_many(self, model, keys: Iterable[Any], field: str = 'pk') -> Dict[Any, Any]:
+        """
+        Получить объекты model по значениям field.
+
+        Отсутствующие в кэше значения загружаются одним запросом.
+        Для неуникального field (email) берется объект с наименьшим pk.
+        """
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for key in set(keys):
+                cache_key = (model, field, key)
+                entry = self._entries.get(cache_key)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(cache_key)
+                    found[key] = entry[0]
+                    self.hits += 1
+                else:
+                    if entry is not None:
+                        del self._entries[cache_key]
+                    missing.append(key)
+                    self.misses += 1
+        if found:
+            metrics.reference_cache_lookups.inc(len(found), model=model.__name__, outcome='hit')
+        if missing:
+            metrics.reference_cache_lookups.inc(len(missing), model=model.__name__, outcome='miss')
+
+        if missing:
+            if field == 'pk':
+                loaded = model.objects.in_bulk(missing)
+            else:
+                loaded = {}
+                for obj in model.objects.filter(**{f'{field}__in': missing}).order_by('pk'):
+                    loaded.setdefault(getattr(obj, field), obj)
+            self._store(model, field, loaded)
+            found.update(loaded)
+
+        return found
+
+    def _store(self, model, field: str, objects: Dict[Any, Any]):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, obj in objects.items():
+                self._entries[(model, field, key)] = (obj, expires)
+                self._entries.move_to_end((model, field, key))
+            evicted = 0
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+            size = len(self._entries)
+        if evicted:
+            metrics.reference_cache_evictions.inc(evicted)
+        metrics.reference_cache_size.set(size)
+
+    def invalidate(self, model=None):
+        """Сбросить записи model (или весь кэш) в текущем процессе"""
+        with self._lock:
+            if model is None:
+                self._entries.clear()
+            else:
+                for cache_key in [k for k in self._entries if k[0] is model]:
+                    del self._entries[cache_key]
+            size = len(self._entries)
+        metrics.reference_cache_size.set(size)
+
+    def sync(self):
+        """Сбросить кэш, если справочники менялись в другом процессе (один запрос к общему кэшу)"""
+        try:
+            generation = cache.get(GENERATION_CACHE_KEY)
+        except Exception as e:
+            logger.warning(f"Failed to read reference cache generation: {e}")
+            return
+        if generation != self._generation:
+            if self._generation is not None:
+                logger.debug("Reference data changed in another process, clearing reference cache")
+            self.invalidate()
+            self._generation = generation
+
+    def reset_after_fork(self):
+        """Пересоздать блокировку в дочернем процессе: при fork ее мог удерживать другой поток"""
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики попаданий/промахов для мониторинга"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def bump_generation():
+    """Сообщить другим процессам, что справочники изменились"""
+    try:
+        if not cache.add(GENERATION_CACHE_KEY, 1, timeout=None):
+            cache.incr(GENERATION_CACHE_KEY)
+    except Exception as e:
+        logger.warning(f"Failed to bump reference cache generation: {e}")
+
+
+reference_cache = ReferenceCache(
+    max_size=settings.KAFKA_REFERENCE_CACHE_SIZE,
+    ttl=settings.KAFKA_REFERENCE_CACHE_TTL,
+)
+
+os.register_at_fork(after_in_child=reference_cache.reset_after_fork)
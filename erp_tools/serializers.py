@@ -0,0 +1,97 @@
+from typing import Any, Dict, Iterable, Optional
+
+from django.contrib.contenttypes.models import ContentType
+
+# Поля заявки в снимках (Kafka, выгрузки, API): attname модели -> ключ в данных
+ISSUE_EVENT_FIELDS = {
+    'name': 'name',
+    'content': 'content',
+    'status': 'status',
+    'priority': 'priority',
+    'deadline': 'deadline',
+    'date_create': 'date_create',
+    'date_check': 'date_check',
+    'date_start_plan': 'date_start_plan',
+    'date_end_plan': 'date_end_plan',
+    'Companies_id': 'company_id',
+    'Services_id': 'service_id',
+    'DataBases_id': 'database_id',
+    'users_id': 'user_id',
+    'supervisor_id': 'supervisor_id',
+    'applicant_content_type_id': 'applicant_type',
+    'applicant_object_id': 'applicant_id',
+    'sprint_id': 'sprint_id',
+    'parent_id': 'parent_id',
+    'time_dead_line': 'time_dead_line',
+    'time_check': 'time_check',
+    'sla_reac': 'sla_reac',
+    'sla_exec': 'sla_exec',
+    'sla_check': 'sla_check',
+    'sla_deadline': 'sla_deadline',
+}
+
+
+def event_value(attname: str, value: Any) -> Any:
+    """
+    Значение поля заявки в формате снимка.
+
+    Тип заявителя берется из кэша ContentType (get_for_id), а не через
+    ленивый FK applicant_content_type, поэтому запроса к БД нет.
+    datetime и Decimal остаются как есть: их кодирует erp_tools.json_codec.
+    """
+    if value is not None and attname == 'applicant_content_type_id':
+        return ContentType.objects.get_for_id(value).model
+    return value
+
+
+def serialize_issue(issue) -> Dict[str, Any]:
+    """Полный снимок заявки; использует только поля экземпляра и не выполняет запросов"""
+    data = {'id': issue.pk}
+    for attname, key in ISSUE_EVENT_FIELDS.items():
+        data[key] = event_value(attname, getattr(issue, attname))
+    data['content'] = data['content'] or ''
+    return data
+
+
+def serialize_issue_delta(issue, old_values: Optional[Dict[str, Any]], update_fields: Optional[Iterable[str]] = None):
+    """
+    Компактные данные обновления заявки: только измененные поля и их старые значения.
+
+    old_values - значения полей до сохранения (по attname); при update_fields
+    сравниваются только перечисленные поля. Возвращает None, если старые
+    значения неизвестны.
+    """
+    if old_values is None:
+        return None
+
+    attnames = ISSUE_EVENT_FIELDS.keys()
+    if update_fields:
+        fields = {issue._meta.get_field(name).attname for name in update_fields}
+        attnames = [attname for attname in attnames if attname in fields]
+
+    changed = {}
+    old = {}
+    for attname in attnames:
+        new_value = getattr(issue, attname)
+        if new_value != old_values[attname]:
+            key = ISSUE_EVENT_FIELDS[attname]
+            changed[key] = event_value(attname, new_value)
+            old[key] = event_value(attname, old_values[attname])
+
+    return {
+        'id': issue.pk,
+        'format': 'delta',
+        'changed': changed,
+        'old': old,
+    }
+
+
+def serialize_comment(comment) -> Dict[str, Any]:
+    """Снимок комментария к заявке (автор берется из уже загруженного объекта user)"""
+    return {
+        'comment_id': comment.pk,
+        'comment': comment.comment or '',
+        'user_id': comment.user_id,
+        'user_name': comment.user.name if comment.user_id else None,
+        'date_create': comment.date_create,
+    }
@@ -1,185 +1,182 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
-from erp_tools.models import Issues, IssueComments
+from erp_tools.models import Issues, IssueComments, Companies, Services, DataBases, Users, Projects, ProjectTeams
 from erp_tools.kafka_service import KafkaService
+from erp_tools import profile_cache
+from erp_tools.reference_cache import bump_generation, reference_cache
+from erp_tools.serializers import ISSUE_EVENT_FIELDS, serialize_comment, serialize_issue, serialize_issue_delta
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Глобальный словарь для хранения старого статуса заявки
-_old_statuses = {}
-
-
 @receiver(pre_save, sender=Issues)
 def issue_pre_save(sender, instance, **kwargs):
-    """Сохранить старый статус перед сохранением"""
-    if instance.pk:
-        try:
-            old_instance = Issues.objects.get(pk=instance.pk)
-            instance._old_status = old_instance.status
-            _old_statuses[instance.pk] = old_instance.status
-        except Issues.DoesNotExist:
-            instance._old_status = None
-            _old_statuses.pop(instance.pk, None)
-    else:
-        instance._old_status = None
+    """Сохранить старый статус и значения полей перед сохранением"""
+    instance._old_status = None
+    instance._old_values = None
+    if not instance.pk:
+        return
+    
+    # Обычно старые значения берутся из снимка Issues.from_db без запроса к БД
+    old_values = instance.loaded_values
+    missing = [attname for attname in ISSUE_EVENT_FIELDS if attname not in old_values]
+    if missing:
+        # Экземпляр создан не из БД или загружен с отложенными полями
+        stored = Issues.objects.filter(pk=instance.pk).values(*missing).first()
+        if stored is None:
+            return
+        old_values = {**old_values, **stored}
+    
+    instance._old_status = old_values['status']
+    instance._old_values = {attname: old_values[attname] for attname in ISSUE_EVENT_FIELDS}
 
 
 @receiver(post_save, sender=Issues)
 def issue_post_save(sender, instance, created, **kwargs):
-    """Отправить событие в Kafka при создании/обновлении заявки"""
+    """Опубликовать событие в Kafka при создании/обновлении заявки"""
     if hasattr(instance, '_skip_kafka_event'):
+        # Изменение из 1С не возвращается в топик событий, но попадает в топик состояния
+        KafkaService.publish_issue_states([instance.pk])
         return
     
-    # Если комментарий будет создан вместе с обновлением/созданием, откладываем отправку
-    if hasattr(instance, '_creating_comment_with_update') and instance._creating_comment_with_update:
-        logger.info(f"Delaying issue {'create' if created else 'update'} event for issue {instance.pk} - comment will be created")
-        return
+    # Событие сохранения и событие комментария, созданного вместе с ним,
+    # объединяются relay_issue_events в одно сообщение ('*_with_comment')
+    snapshot = serialize_issue(instance)
+    issue_data = dict(snapshot)
     
-    try:
-        issue_data = {
-            'id': instance.pk,
-            'name': instance.name,
-            'content': instance.content or '',
-            'status': instance.status,
-            'priority': instance.priority,
-            'deadline': instance.deadline.isoformat() if instance.deadline else None,
-            'date_create': instance.date_create.isoformat() if instance.date_create else None,
-            'date_check': instance.date_check.isoformat() if instance.date_check else None,
-            'date_start_plan': instance.date_start_plan.isoformat() if instance.date_start_plan else None,
-            'date_end_plan': instance.date_end_plan.isoformat() if instance.date_end_plan else None,
-            'company_id': instance.Companies_id,
-            'service_id': instance.Services_id,
-            'database_id': instance.DataBases_id,
-            'user_id': instance.users_id,
-            'supervisor_id': instance.supervisor_id,
-            'applicant_type': instance.applicant_content_type.model if instance.applicant_content_type else None,
-            'applicant_id': instance.applicant_object_id,
-            'sprint_id': instance.sprint_id,
-            'parent_id': instance.parent_id,
-        }
+    if created:
+        KafkaService.publish_issue_event('created', issue_data, instance.pk)
+        logger.info(f"Published 'created' event for issue {instance.pk}")
+    else:
+        if settings.KAFKA_ISSUE_EVENT_FORMAT == 'delta':
+            delta = serialize_issue_delta(instance, instance._old_values, kwargs.get('update_fields'))
+            if delta is not None:
+                if not delta['changed']:
+                    logger.debug(f"No tracked fields changed for issue {instance.pk}, event skipped")
+                    return
+                issue_data = delta
         
-        if created:
-            KafkaService.send_issue_event('created', issue_data, instance.pk)
-            logger.info(f"Sent 'created' event for issue {instance.pk}")
+        old_status = getattr(instance, '_old_status', None)
+        if old_status and old_status != instance.status:
+            issue_data['old_status'] = old_status
+            issue_data['new_status'] = instance.status
+            KafkaService.publish_issue_event('status_changed', issue_data, instance.pk)
+            logger.info(f"Published 'status_changed' event for issue {instance.pk}: {old_status} -> {instance.status}")
         else:
-            old_status = getattr(instance, '_old_status', None)
-            if old_status and old_status != instance.status:
-                issue_data['old_status'] = old_status
-                issue_data['new_status'] = instance.status
-                # Если есть комментарий, это событие изменения статуса с комментарием
-                event_type = 'status_changed_with_comment' if 'comment' in issue_data else 'status_changed'
-                KafkaService.send_issue_event(event_type, issue_data, instance.pk)
-                logger.info(f"Sent '{event_type}' event for issue {instance.pk}: {old_status} -> {instance.status}")
-            else:
-                # Если есть комментарий, это обновление с комментарием
-                event_type = 'updated_with_comment' if 'comment' in issue_data else 'updated'
-                KafkaService.send_issue_event(event_type, issue_data, instance.pk)
-                logger.info(f"Sent '{event_type}' event for issue {instance.pk}")
-                
-    except Exception as e:
-        logger.error(f"Error sending issue event to Kafka: {e}", exc_info=True)
+            KafkaService.publish_issue_event('updated', issue_data, instance.pk)
+            logger.info(f"Published 'updated' event for issue {instance.pk}")
+    
+    KafkaService.publish_issue_state(instance.pk, snapshot)
 
 
 @receiver(post_delete, sender=Issues)
 def issue_post_delete(sender, instance, **kwargs):
-    """Отправить событие в Kafka при удалении заявки"""
-    try:
-        issue_data = {
-            'id': instance.pk,
-            'name': instance.name,
-        }
-        KafkaService.send_issue_event('deleted', issue_data, instance.pk)
-        logger.info(f"Sent 'deleted' event for issue {instance.pk}")
-    except Exception as e:
-        logger.error(f"Error sending delete event to Kafka: {e}", exc_info=True)
+    """Опубликовать событие в Kafka при удалении заявки"""
+    issue_data = {
+        'id': instance.pk,
+        'name': instance.name,
+    }
+    KafkaService.publish_issue_event('deleted', issue_data, instance.pk)
+    logger.info(f"Published 'deleted' event for issue {instance.pk}")
+    KafkaService.publish_issue_state(instance.pk, None)
 
 
 @receiver(post_save, sender=IssueComments)
 def issue_comment_post_save(sender, instance, created, **kwargs):
-    """Отправить событие в Kafka при добавлении комментария"""
+    """Опубликовать событие в Kafka при добавлении комментария"""
     if created and instance.issue:
         if hasattr(instance, '_skip_kafka_event'):
             return
         
-        try:
-            issue = instance.issue
-            
-            # Проверяем, был ли комментарий создан вместе с обновлением заявки
-            if hasattr(issue, '_creating_comment_with_update') and issue._creating_comment_with_update:
-                # Удаляем флаг
-                delattr(issue, '_creating_comment_with_update')
-                
-                # Отправляем объединенное сообщение об обновлении с комментарием
-                # Перезагружаем issue из БД, чтобы получить актуальные данные
-                issue_obj = Issues.objects.get(pk=issue.pk)
-                
-                # Получаем старый статус из глобального словаря
-                old_status = _old_statuses.pop(issue.pk, None)
-                
-                issue_data = {
-                    'id': issue_obj.pk,
-                    'name': issue_obj.name,
-                    'content': issue_obj.content or '',
-                    'status': issue_obj.status,
-                    'priority': issue_obj.priority,
-                    'deadline': issue_obj.deadline.isoformat() if issue_obj.deadline else None,
-                    'date_create': issue_obj.date_create.isoformat() if issue_obj.date_create else None,
-                    'date_check': issue_obj.date_check.isoformat() if issue_obj.date_check else None,
-                    'date_start_plan': issue_obj.date_start_plan.isoformat() if issue_obj.date_start_plan else None,
-                    'date_end_plan': issue_obj.date_end_plan.isoformat() if issue_obj.date_end_plan else None,
-                    'company_id': issue_obj.Companies_id,
-                    'service_id': issue_obj.Services_id,
-                    'database_id': issue_obj.DataBases_id,
-                    'user_id': issue_obj.users_id,
-                    'supervisor_id': issue_obj.supervisor_id,
-                    'applicant_type': issue_obj.applicant_content_type.model if issue_obj.applicant_content_type else None,
-                    'applicant_id': issue_obj.applicant_object_id,
-                    'sprint_id': issue_obj.sprint_id,
-                    'parent_id': issue_obj.parent_id,
-                    'comment': {
-                        'comment_id': instance.pk,
-                        'comment': instance.comment or '',
-                        'user_id': instance.user_id,
-                        'user_name': instance.user.name if instance.user else None,
-                        'date_create': instance.date_create.isoformat() if instance.date_create else None,
-                    }
-                }
-                
-                # Определяем тип события
-                # Проверяем, была ли заявка только что создана (нет старого статуса и заявка создана недавно)
-                from django.utils import timezone
-                from datetime import timedelta
-                
-                is_newly_created = (
-                    old_status is None and 
-                    issue_obj.date_create and 
-                    (timezone.now() - issue_obj.date_create) < timedelta(seconds=5)
-                )
-                
-                if is_newly_created:
-                    event_type = 'created_with_comment'
-                elif old_status and old_status != issue_obj.status:
-                    issue_data['old_status'] = old_status
-                    issue_data['new_status'] = issue_obj.status
-                    event_type = 'status_changed_with_comment'
-                else:
-                    event_type = 'updated_with_comment'
-                
-                KafkaService.send_issue_event(event_type, issue_data, issue_obj.pk)
-                logger.info(f"Sent '{event_type}' event with comment for issue {issue_obj.pk}")
-                return
-            
-            # Если комментарий создан отдельно, отправляем отдельное сообщение
-            comment_data = {
-                'issue_id': instance.issue.pk,
-                'comment_id': instance.pk,
-                'comment': instance.comment or '',
-                'user_id': instance.user_id,
-                'user_name': instance.user.name if instance.user else None,
-                'date_create': instance.date_create.isoformat() if instance.date_create else None,
-            }
-            KafkaService.send_issue_event('comment_added', comment_data, instance.issue.pk)
-            logger.info(f"Sent 'comment_added' event for issue {instance.issue.pk}")
-        except Exception as e:
-            logger.error(f"Error sending comment event to Kafka: {e}", exc_info=True)
\ No newline at end of file
+        comment_data = {'issue_id': instance.issue_id, **serialize_comment(instance)}
+        KafkaService.publish_issue_event('comment_added', comment_data, instance.issue.pk)
+        logger.info(f"Published 'comment_added' event for issue {instance.issue.pk}")
+
+
+@receiver(post_save, sender=Companies)
+@receiver(post_delete, sender=Companies)
+@receiver(post_save, sender=Services)
+@receiver(post_delete, sender=Services)
+@receiver(post_save, sender=DataBases)
+@receiver(post_delete, sender=DataBases)
+@receiver(post_save, sender=Users)
+@receiver(post_delete, sender=Users)
+def reference_data_changed(sender, **kwargs):
+    """Сбросить кэш справочников consumer-а 1С при изменении справочника"""
+    reference_cache.invalidate(sender)
+    bump_generation()
+
+
+@receiver(post_save, sender=Users)
+@receiver(post_delete, sender=Users)
+def profile_changed(sender, instance, **kwargs):
+    """Сбросить кэш профиля (request.profile) пользователя"""
+    profile_cache.invalidate_profile(instance.auth_user_id)
+
+
+@receiver(post_save, sender=get_user_model())
+def auth_user_changed(sender, instance, **kwargs):
+    """Права в кэше профиля зависят от is_superuser пользователя системы"""
+    profile_cache.invalidate_profile(instance.pk)
+
+
+@receiver(post_save, sender=Projects)
+@receiver(post_delete, sender=Projects)
+@receiver(post_save, sender=ProjectTeams)
+@receiver(post_delete, sender=ProjectTeams)
+def project_access_changed(sender, **kwargs):
+    """Менеджеры проектов и роли в командах входят в кэш прав всех пользователей"""
+    profile_cache.bump_generation()
+
+
+@receiver(post_save, sender=Companies)
+def company_project_changed(sender, instance, created, update_fields, **kwargs):
+    """Пересчитать проект заявок компании и заявок ее услуг"""
+    if not _project_link_changed(instance, 'owner', created, update_fields):
+        return
+    _refresh_issues_project(Issues.objects.filter(Companies=instance))
+    _refresh_issues_project(Issues.objects.filter(Services__company=instance))
+
+
+@receiver(post_save, sender=DataBases)
+def database_project_changed(sender, instance, created, update_fields, **kwargs):
+    """Пересчитать проект заявок базы данных"""
+    if not _project_link_changed(instance, 'owner', created, update_fields):
+        return
+    _refresh_issues_project(Issues.objects.filter(DataBases=instance))
+
+
+@receiver(post_save, sender=Services)
+def service_project_changed(sender, instance, created, update_fields, **kwargs):
+    """Пересчитать проект заявок услуги (она перешла к другой компании)"""
+    if not _project_link_changed(instance, 'company', created, update_fields):
+        return
+    _refresh_issues_project(Issues.objects.filter(Services=instance))
+
+
+def _project_link_changed(instance, field: str, created: bool, update_fields) -> bool:
+    """
+    Изменилась ли при сохранении связь field, от которой зависит проект заявок.
+
+    У новой записи заявок еще нет. Для объекта, созданного не из БД (нет
+    loaded_values), прежнее значение неизвестно - считается измененным.
+    """
+    if created:
+        return False
+    if update_fields is not None and field not in {name.removesuffix('_id') for name in update_fields}:
+        return False
+    attname = f"{field}_id"
+    loaded = instance.loaded_values
+    if not loaded:
+        return True
+    return attname in loaded and loaded[attname] != getattr(instance, attname)
+
+
+def _refresh_issues_project(issues):
+    # Проект определяется по всем связям заявки (Issues.project_expression), а не только
+    # по сохраненной: у компании может не быть проекта, тогда действует база данных или услуга
+    updated = Issues.refresh_projects(issues)
+    if updated:
+        logger.info(f"Updated project of {updated} issues")
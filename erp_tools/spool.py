@@ -0,0 +1,176 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from erp_tools import json_codec
+
+logger = logging.getLogger(__name__)
+
+
+class DiskSpool:
+    """
+    Локальный append-only буфер сообщений на диске.
+
+    Записи хранятся строками JSON в сегментах segment-<номер>.log; при превышении
+    segment_bytes открывается следующий сегмент. Каждая запись сразу передается
+    ОС (переживает падение процесса), fsync выполняется раз в fsync_every записей
+    или fsync_interval секунд. replay() отдает записи в порядке добавления и
+    запоминает позицию доставленных в файле <сегмент>.pos; полностью
+    доставленный сегмент удаляется.
+
+    Каталог захватывается flock-ом на весь срок жизни объекта, поэтому буфер
+    работающего процесса не может быть прочитан другим процессом.
+    """
+
+    SEGMENT_PATTERN = 'segment-*.log'
+
+    def __init__(self, directory, segment_bytes: int, fsync_every: int, fsync_interval: float):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.fsync_every = max(1, fsync_every)
+        self.fsync_interval = fsync_interval
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._owner = open(self.directory / '.lock', 'a')
+        try:
+            # BlockingIOError, если каталог принадлежит другому процессу
+            fcntl.flock(self._owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._owner.close()
+            raise
+
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._file = None
+        self._file_size = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._has_data = bool(self._segments())
+
+    def pending(self) -> bool:
+        """Есть ли недоставленные записи"""
+        return self._has_data
+
+    def append(self, record: Dict[str, Any]):
+        """Добавить запись в конец буфера"""
+        line = json_codec.dumps(record) + b'\n'
+        with self._lock:
+            if self._file is None or (self._file_size and self._file_size + len(line) > self.segment_bytes):
+                self._open_segment()
+            self._file.write(line)
+            self._file.flush()
+            self._file_size += len(line)
+            self._unsynced += 1
+            self._has_data = True
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def sync(self):
+        """Принудительно сбросить записанные данные на диск"""
+        with self._lock:
+            self._sync()
+
+    def replay(self, deliver: Callable[[List[Dict[str, Any]]], None], batch_size: int) -> int:
+        """
+        Передать накопленные записи в deliver пачками по batch_size.
+
+        deliver должен выбросить исключение, если пачка не доставлена; тогда
+        позиция не сдвигается и при следующем replay пачка отправляется снова
+        (доставка at-least-once). Записи, добавленные во время replay, попадают
+        в новый сегмент и отдаются следующим вызовом.
+
+        Returns:
+            Количество доставленных записей
+        """
+        with self._replay_lock:
+            with self._lock:
+                self._close_segment()
+                segments = self._segments()
+
+            delivered = 0
+            for path in segments:
+                delivered += self._replay_segment(path, deliver, batch_size)
+                path.unlink()
+                self._position_path(path).unlink(missing_ok=True)
+
+            with self._lock:
+                self._has_data = bool(self._segments())
+            return delivered
+
+    def close(self):
+        """Сбросить данные на диск и освободить каталог; пустой каталог удаляется"""
+        with self._lock:
+            self._close_segment()
+            if not self._segments():
+                for path in self.directory.iterdir():
+                    path.unlink()
+                self.directory.rmdir()
+            self._owner.close()
+
+    def _replay_segment(self, path: Path, deliver, batch_size: int) -> int:
+        position = self._read_position(path)
+        delivered = 0
+        batch = []
+        with open(path, 'rb') as f:
+            f.seek(position)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Запись оборвалась при падении процесса
+                    logger.warning(f"Truncated record at the end of spool segment {path}, skipped")
+                    break
+                try:
+                    batch.append(json_codec.loads(line))
+                except ValueError as e:
+                    logger.error(f"Corrupted record in spool segment {path} skipped: {e}")
+                position += len(line)
+                if len(batch) >= batch_size:
+                    deliver(batch)
+                    delivered += len(batch)
+                    batch = []
+                    self._write_position(path, position)
+        if batch:
+            deliver(batch)
+            delivered += len(batch)
+        return delivered
+
+    def _segments(self) -> List[Path]:
+        return sorted(self.directory.glob(self.SEGMENT_PATTERN))
+
+    def _open_segment(self):
+        self._close_segment()
+        segments = self._segments()
+        number = int(segments[-1].stem.split('-')[1]) + 1 if segments else 1
+        self._file = open(self.directory / f'segment-{number:010d}.log', 'ab')
+        self._file_size = 0
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+            self._file_size = 0
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    @staticmethod
+    def _position_path(path: Path) -> Path:
+        return path.with_suffix('.pos')
+
+    def _read_position(self, path: Path) -> int:
+        try:
+            return int(self._position_path(path).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_position(self, path: Path, position: int):
+        tmp = self._position_path(path).with_suffix('.pos.tmp')
+        tmp.write_text(str(position))
+        os.replace(tmp, self._position_path(path))
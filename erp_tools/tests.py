@@ -1,3 +1,246 @@
-from django.test import TestCase
+import json
+import tempfile
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import OperationalError, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from kafka.consumer.fetcher import ConsumerRecord
+from kafka.structs import TopicPartition
+
+from erp_tools import metrics
+from erp_tools.consumer_dispatch import OffsetTracker, RetryScheduler
+from erp_tools.kafka_service import KafkaService
+from erp_tools.models import Accounts, Companies, DataBases, IssueComments, Issues, OutboxEvents, Projects, Users
+from erp_tools.profile_cache import load_profile_access
+from erp_tools.reference_cache import ReferenceCache
+
+
+class FakeFuture:
+    def __init__(self, topic):
+        self.metadata = SimpleNamespace(topic=topic, partition=0, offset=0)
+
+    def get(self, timeout=None):
+        return self.metadata
+
+    def add_callback(self, callback, *args, **kwargs):
+        callback(self.metadata, *args, **kwargs)
+        return self
+
+    def add_errback(self, errback, *args, **kwargs):
+        return self
+
+
+class FakeProducer:
+    """Producer без брокера: запоминает отправленные сообщения"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, topic, key=None, value=None, headers=None):
+        self.sent.append((topic, key, value))
+        return FakeFuture(topic)
+
+    def flush(self, timeout=None):
+        pass
+
+    def event_types(self, topic=None):
+        topic = topic or settings.KAFKA_ISSUES_TOPIC
+        return [value['event_type'] for sent_topic, key, value in self.sent if sent_topic == topic]
+
+
+@override_settings(KAFKA_ISSUES_STATE_TOPIC='', KAFKA_OUTBOX_COALESCE_MAX_DELAY_MS=10000)
+class IssueEventShapeTests(TestCase):
+    """Смена статуса с комментарием при разных настройках доставки событий"""
+
+    def setUp(self):
+        self.issue = Issues.objects.create(name='Заявка')
+        OutboxEvents.objects.all().delete()
+        self.producer = FakeProducer()
+        patcher = mock.patch.object(KafkaService, 'get_producer', return_value=self.producer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def change_status_with_comment(self):
+        with transaction.atomic():
+            self.issue.status = 'in_progress'
+            self.issue.save()
+            IssueComments.objects.create(issue=self.issue, comment='Взята в работу')
+
+    def relay(self):
+        # События старше окна объединения
+        OutboxEvents.objects.update(date_create=timezone.now() - timedelta(minutes=1))
+        return KafkaService.relay_outbox(100)
+
+    @override_settings(KAFKA_OUTBOX_ENABLED=True, KAFKA_OUTBOX_COALESCE_WINDOW_MS=2000)
+    def test_outbox_with_window_sends_combined_event(self):
+        self.change_status_with_comment()
+        self.assertEqual(self.relay(), 2)
+        self.assertEqual(self.producer.event_types(), ['status_changed_with_comment'])
+        message = self.producer.sent[0][2]
+        self.assertEqual(message['data']['new_status'], 'in_progress')
+        self.assertEqual(message['data']['comment']['comment'], 'Взята в работу')
+
+    @override_settings(KAFKA_OUTBOX_ENABLED=True, KAFKA_OUTBOX_COALESCE_WINDOW_MS=0)
+    def test_outbox_without_window_sends_separate_events(self):
+        self.change_status_with_comment()
+        self.assertEqual(self.relay(), 2)
+        self.assertEqual(self.producer.event_types(), ['status_changed', 'comment_added'])
+
+    @override_settings(KAFKA_OUTBOX_ENABLED=False)
+    def test_direct_send_sends_separate_events(self):
+        self.change_status_with_comment()
+        self.assertEqual(self.producer.event_types(), ['status_changed', 'comment_added'])
+        self.assertFalse(OutboxEvents.objects.exists())
+
+
+def consumer_record(offset, message, key=b'issue-1'):
+    return ConsumerRecord(
+        '1c-issues', 0, -1, offset, 0, 0, key, json.dumps(message).encode('utf-8'), [], None, -1, -1, -1
+    )
+
+
+class RetrySchedulerTests(SimpleTestCase):
+    def test_records_wait_behind_deferred_record_of_same_key(self):
+        retries = RetryScheduler(5, base_delay=0, max_delay=0)
+        first, second, third, other = (consumer_record(offset, {}) for offset in range(4))
+        self.assertTrue(retries.schedule(first, OperationalError(), key='issue-1'))
+        self.assertEqual(retries.admit('issue-1', second), [])
+        self.assertEqual(retries.admit('issue-2', other), [other])
+        self.assertEqual(retries.pop_due(), [first])
+        # Сообщение, полученное потоком до повтора, все еще ждет
+        self.assertEqual(retries.admit('issue-1', third), [])
+        self.assertEqual(retries.admit('issue-1', first), [first, second, third])
+        self.assertEqual(retries.admit('issue-1', third), [third])
+
+
+@override_settings(KAFKA_CONSUMER_BATCH_MODE=False, KAFKA_ISSUES_STATE_TOPIC='')
+class ConsumerOrderingTests(TestCase):
+    def setUp(self):
+        self.issue = Issues.objects.create(name='Заявка')
+        patcher = mock.patch.object(KafkaService, 'get_producer', return_value=FakeProducer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def status_record(self, offset, status):
+        message = {'event_type': 'status_changed', 'issue_id': self.issue.pk, 'data': {'status': status}}
+        return consumer_record(offset, message)
+
+    def test_retry_keeps_order_of_same_issue(self):
+        apply_1c_message = KafkaService._apply_1c_message
+        failed = []
+
+        def fail_once(message):
+            if message['data']['status'] == 'in_progress' and not failed:
+                failed.append(message)
+                raise OperationalError('deadlock detected')
+            apply_1c_message(message)
+
+        tracker = OffsetTracker()
+        retries = RetryScheduler(5, base_delay=0, max_delay=0)
+        records = [self.status_record(0, 'in_progress'), self.status_record(1, 'done')]
+        with mock.patch.object(KafkaService, '_apply_1c_message', side_effect=fail_once):
+            KafkaService._process_records(tracker, records, retries)
+            self.issue.refresh_from_db()
+            self.assertEqual(self.issue.status, 'new')
+            self.assertEqual(len(retries), 2)
+            self.assertEqual(tracker.pop_committable(), {})
+
+            KafkaService._process_due_retries(tracker, retries)
+
+        self.issue.refresh_from_db()
+        self.assertEqual(self.issue.status, 'done')
+        self.assertEqual(len(retries), 0)
+        self.assertEqual(tracker.pop_committable(), {TopicPartition('1c-issues', 0): 2})
+
+
+class ProfileCacheTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('alice', 'alice@example.com', 'pw')
+        self.addCleanup(cache.clear)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_process_local_cache_is_not_used(self):
+        load_profile_access(self.user)
+        Users.objects.filter(auth_user=self.user).update(role='admin')
+        self.assertTrue(load_profile_access(self.user).is_admin)
+
+    def test_shared_cache_is_used_and_invalidated(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        caches = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': directory.name,
+            }
+        }
+        with self.settings(CACHES=caches):
+            load_profile_access(self.user)
+            with self.assertNumQueries(0):
+                self.assertFalse(load_profile_access(self.user).is_admin)
+            profile = Users.objects.get(auth_user=self.user)
+            profile.role = 'admin'
+            profile.save()
+            self.assertTrue(load_profile_access(self.user).is_admin)
+
+
+class MetricsViewTests(TestCase):
+    def test_requires_staff_or_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 401)
+
+        user = get_user_model().objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/metrics/').status_code, 401)
+
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+
+    @override_settings(METRICS_AUTH_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE reference_cache_lookups_total counter', response.content)
+
+    def test_reference_cache_lookups_are_counted(self):
+        company = Companies.objects.create(name='ООО Ромашка')
+        reference_cache = ReferenceCache(max_size=10, ttl=60)
+        metrics.reference_cache_lookups.clear()
+        reference_cache.get(Companies, company.pk)
+        reference_cache.get(Companies, company.pk)
+        rendered = metrics.registry.render()
+        self.assertIn('reference_cache_lookups_total{model="Companies",outcome="hit"} 1.0', rendered)
+        self.assertIn('reference_cache_lookups_total{model="Companies",outcome="miss"} 1.0', rendered)
+
+
+class IssueProjectTests(TestCase):
+    def setUp(self):
+        account = Accounts.objects.create(name='Клиент')
+        self.first, self.second = (Projects.objects.create(owner=account, name=name) for name in ('Первый', 'Второй'))
+        self.company = Companies.objects.create(name='ООО Ромашка', owner=self.first)
+        self.database = DataBases.objects.create(path='/base', server='srv', owner=self.second)
+        self.issue = Issues.objects.create(name='Заявка', Companies=self.company, DataBases=self.database)
+
+    def test_company_project_has_priority(self):
+        self.assertEqual(self.issue.project_id, self.first.pk)
+
+    def test_company_without_project_falls_back_to_database(self):
+        company = Companies.objects.get(pk=self.company.pk)
+        company.owner = None
+        company.save()
+        self.issue.refresh_from_db()
+        self.assertEqual(self.issue.project_id, self.second.pk)
+
+    def test_save_without_project_change_does_not_touch_issues(self):
+        company = Companies.objects.get(pk=self.company.pk)
+        company.name = 'ООО Лютик'
+        with self.assertNumQueries(1):
+            company.save()
+        with self.assertNumQueries(1):
+            company.save(update_fields=['name'])
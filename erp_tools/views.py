@@ -1,15 +1,22 @@
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.db.models import Q
-from django.http import JsonResponse
+from django.db import transaction
+from django.db.models import Count
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.crypto import constant_time_compare
 from django.utils.timezone import localtime
 from django.views.decorators.http import require_http_methods
 import json
 
+from . import json_codec, metrics
+from .json_codec import JsonResponse
+from .pagination import InvalidCursor, keyset_paginate, parse_sort
 from .forms import (
     AccountCreateForm,
     AdminUserCreateForm,
@@ -46,16 +53,15 @@ CLIENT_TEAM_ALLOWED_ROLES = {
 }
 
 
-def refresh_permitted_accounts(profile):
-    if profile.role == "admin" or (profile.auth_user and profile.auth_user.is_superuser):
-        permitted_ids = list(Accounts.objects.values_list("id", flat=True))
-    else:
-        permitted_ids = list(Accounts.objects.filter(user=profile).values_list("id", flat=True))
-
-    if profile.permitted_accounts != permitted_ids:
-        profile.permitted_accounts = permitted_ids
-        profile.save(update_fields=["permitted_accounts"])
-    return permitted_ids
+def permitted_accounts(access):
+    """
+    Аккаунты, доступные пользователю: администратору - все, остальным - те,
+    где он управляющий (Accounts.user). Список не хранится отдельно, а
+    вычисляется запросом по индексу внешнего ключа, поэтому всегда актуален.
+    """
+    if access.is_admin:
+        return Accounts.objects.all()
+    return Accounts.objects.filter(user=access.profile)
 
 
 def login_view(request):
@@ -73,16 +79,6 @@ def login_view(request):
                 user = authenticate(request, username=email, password=password)
                 if user is not None:
                     login(request, user)
-                    # Получаем профиль пользователя
-                    profile, _ = Users.objects.get_or_create(
-                        auth_user=user,
-                        defaults={
-                            "name": user.username,
-                            "email": user.email,
-                            "role": "user",
-                        },
-                    )
-                    refresh_permitted_accounts(profile)
 
                     # Все пользователи идут на /projects
                     return redirect("projects")
@@ -98,7 +94,7 @@ def login_view(request):
                 password = register_form.cleaned_data["password1"]
 
                 user = User.objects.create_user(username=email, email=email, password=password)
-                profile, _ = Users.objects.update_or_create(
+                Users.objects.update_or_create(
                     auth_user=user,
                     defaults={
                         "name": name,
@@ -107,7 +103,6 @@ def login_view(request):
                     },
                 )
                 login(request, user)
-                refresh_permitted_accounts(profile)
 
                 messages.success(request, "Аккаунт создан и пользователь авторизован.")
                 # Все пользователи идут на /projects
@@ -128,22 +123,16 @@ def logout_view(request):
 
 @login_required(login_url="login")
 def accounts_view(request):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-
-    permitted_ids = refresh_permitted_accounts(profile)
+    profile = request.profile
 
     if not profile.email and request.user.email:
-        profile.email = request.user.email
-        profile.save()
+        # Профиль из кэша может быть устаревшим: записывается только email актуальной строки
+        profile = Users.objects.get(pk=profile.pk)
+        if not profile.email:
+            profile.email = request.user.email
+            profile.save(update_fields=["email"])
 
-    is_admin = profile.role == "admin" or request.user.is_superuser
+    is_admin = request.access.is_admin
     manager_queryset = Users.objects.all().order_by("name") if is_admin else Users.objects.none()
 
     if request.method == "POST" and not is_admin:
@@ -166,8 +155,6 @@ def accounts_view(request):
                     messages.error(request, "Нужно выбрать управляющего.")
                     return redirect("accounts")
                 account.save()
-                if account.user:
-                    refresh_permitted_accounts(account.user)
                 messages.success(request, "Аккаунт создан.")
                 return redirect("accounts")
         elif action == "create_user":
@@ -197,7 +184,6 @@ def accounts_view(request):
                     new_profile.phone = phone
                     new_profile.owner = owner
                     new_profile.save()
-                refresh_permitted_accounts(new_profile)
                 messages.success(request, "Пользователь успешно создан.")
                 return redirect("accounts")
         else:
@@ -207,7 +193,7 @@ def accounts_view(request):
         form = AccountCreateForm(is_admin=is_admin, manager_queryset=manager_queryset) if is_admin else None
         user_form = AdminUserCreateForm() if is_admin else None
 
-    accounts = Accounts.objects.filter(pk__in=permitted_ids).order_by("-date_create")
+    accounts = permitted_accounts(request.access).order_by("-date_create")
     context = {
         "accounts": accounts,
         "form": form,
@@ -220,16 +206,9 @@ def accounts_view(request):
 
 @login_required(login_url="login")
 def account_update_view(request, pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
+    profile = request.profile
     account = get_object_or_404(Accounts, pk=pk)
-    is_admin = profile.role == "admin" or request.user.is_superuser
+    is_admin = request.access.is_admin
     if not is_admin and account.user_id != profile.id:
         messages.error(request, "Недостаточно прав для редактирования аккаунта.")
         return redirect("accounts")
@@ -249,49 +228,28 @@ def account_update_view(request, pk):
             else:
                 account.user = profile
             account.save()
-            if account.user:
-                refresh_permitted_accounts(account.user)
             messages.success(request, "Аккаунт обновлён.")
     return redirect("accounts")
 
 
 @login_required(login_url="login")
 def account_delete_view(request, pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
+    profile = request.profile
     account = get_object_or_404(Accounts, pk=pk)
-    is_admin = profile.role == "admin" or request.user.is_superuser
+    is_admin = request.access.is_admin
     if not is_admin and account.user_id != profile.id:
         messages.error(request, "Недостаточно прав для удаления аккаунта.")
         return redirect("accounts")
 
     if request.method == "POST":
-        account_owner = account.user
         account.delete()
-        if account_owner:
-            refresh_permitted_accounts(account_owner)
         messages.success(request, "Аккаунт удалён.")
     return redirect("accounts")
 
 
 @login_required(login_url="login")
 def users_view(request):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-
-    if profile.role != "admin" and not request.user.is_superuser:
+    if not request.access.is_admin:
         messages.error(request, "Недостаточно прав для просмотра пользователей.")
         return redirect("accounts")
 
@@ -322,7 +280,6 @@ def users_view(request):
                 new_profile.phone = phone
                 new_profile.owner = owner
                 new_profile.save()
-            refresh_permitted_accounts(new_profile)
 
             messages.success(request, "Пользователь успешно создан.")
             return redirect("users")
@@ -339,15 +296,7 @@ def users_view(request):
 
 @login_required(login_url="login")
 def user_update_view(request, pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    if profile.role != "admin" and not request.user.is_superuser:
+    if not request.access.is_admin:
         messages.error(request, "Недостаточно прав.")
         return redirect("users")
 
@@ -367,15 +316,7 @@ def user_update_view(request, pk):
 
 @login_required(login_url="login")
 def user_delete_view(request, pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    if profile.role != "admin" and not request.user.is_superuser:
+    if not request.access.is_admin:
         messages.error(request, "Недостаточно прав.")
         return redirect("users")
 
@@ -391,16 +332,9 @@ def user_delete_view(request, pk):
 
 @login_required(login_url="login")
 def projects_view(request):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
+    profile = request.profile
 
-    is_admin = profile.role == "admin" or request.user.is_superuser
+    is_admin = request.access.is_admin
     
     # Для админов - все проекты с возможностью редактирования
     # Для обычных пользователей - только их проекты через ProjectTeams
@@ -523,15 +457,7 @@ def projects_view(request):
 
 @login_required(login_url="login")
 def project_update_view(request, pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    is_admin = profile.role == "admin" or request.user.is_superuser
+    is_admin = request.access.is_admin
     if not is_admin:
         messages.error(request, "Доступ запрещён.")
         return redirect("projects")
@@ -557,15 +483,7 @@ def project_update_view(request, pk):
 
 @login_required(login_url="login")
 def project_delete_view(request, pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    is_admin = profile.role == "admin" or request.user.is_superuser
+    is_admin = request.access.is_admin
     if not is_admin:
         messages.error(request, "Доступ запрещён.")
         return redirect("projects")
@@ -579,15 +497,7 @@ def project_delete_view(request, pk):
 
 @login_required(login_url="login")
 def project_team_add_view(request, project_pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    is_admin = profile.role == "admin" or request.user.is_superuser
+    is_admin = request.access.is_admin
     if not is_admin:
         messages.error(request, "Доступ запрещён.")
         return redirect("projects")
@@ -616,15 +526,7 @@ def project_team_add_view(request, project_pk):
 
 @login_required(login_url="login")
 def project_team_update_view(request, project_pk, team_pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    is_admin = profile.role == "admin" or request.user.is_superuser
+    is_admin = request.access.is_admin
     if not is_admin:
         messages.error(request, "Доступ запрещён.")
         return redirect("projects")
@@ -663,15 +565,7 @@ def project_team_update_view(request, project_pk, team_pk):
 
 @login_required(login_url="login")
 def project_team_delete_view(request, project_pk, team_pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    is_admin = profile.role == "admin" or request.user.is_superuser
+    is_admin = request.access.is_admin
     if not is_admin:
         messages.error(request, "Доступ запрещён.")
         return redirect("projects")
@@ -707,14 +601,7 @@ def is_project_manager(user_profile, project):
 
 @login_required(login_url="login")
 def project_companies_view(request, project_pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
+    profile = request.profile
     project = get_object_or_404(Projects, pk=project_pk)
     is_manager = is_project_manager(profile, project) or request.user.is_superuser
     
@@ -751,14 +638,7 @@ def project_companies_view(request, project_pk):
 
 @login_required(login_url="login")
 def project_databases_view(request, project_pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
+    profile = request.profile
     project = get_object_or_404(Projects, pk=project_pk)
     is_manager = is_project_manager(profile, project) or request.user.is_superuser
     
@@ -794,20 +674,13 @@ def project_databases_view(request, project_pk):
 
 @login_required(login_url="login")
 def service_desk_companies_view(request):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    managed_projects = Projects.objects.filter(manager=profile)
-    can_edit = request.user.is_superuser or managed_projects.exists()
+    profile = request.profile
+    managed_project_ids = request.access.managed_project_ids
+    can_edit = request.user.is_superuser or bool(managed_project_ids)
     if request.user.is_superuser:
         project_queryset = Projects.objects.all().order_by("name")
     else:
-        project_queryset = managed_projects.order_by("name")
+        project_queryset = Projects.objects.filter(pk__in=managed_project_ids).order_by("name")
 
     form = CompanyServiceDeskForm(project_queryset=project_queryset) if can_edit else None
 
@@ -853,24 +726,12 @@ def service_desk_companies_view(request):
 
 @login_required(login_url="login")
 def company_client_teams_view(request, company_pk):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
     company = get_object_or_404(Companies, pk=company_pk)
     project = company.owner
 
     can_create = request.user.is_superuser
     if not can_create and project:
-        can_create = ProjectTeams.objects.filter(
-            owner=project,
-            user=profile,
-            role__in=CLIENT_TEAM_ALLOWED_ROLES,
-        ).exists()
+        can_create = request.access.has_team_role(project.pk, CLIENT_TEAM_ALLOWED_ROLES)
 
     teams = (
         ClientTeams.objects.filter(company=company)
@@ -903,20 +764,12 @@ def company_client_teams_view(request, company_pk):
     return render(request, "client_teams/list.html", context)
 @login_required(login_url="login")
 def service_desk_databases_view(request):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    managed_projects = Projects.objects.filter(manager=profile)
-    can_edit = request.user.is_superuser or managed_projects.exists()
+    managed_project_ids = request.access.managed_project_ids
+    can_edit = request.user.is_superuser or bool(managed_project_ids)
     if request.user.is_superuser:
         project_queryset = Projects.objects.all().order_by("name")
     else:
-        project_queryset = managed_projects.order_by("name")
+        project_queryset = Projects.objects.filter(pk__in=managed_project_ids).order_by("name")
 
     form = DatabaseServiceDeskForm(project_queryset=project_queryset) if can_edit else None
 
@@ -960,16 +813,7 @@ def service_desk_databases_view(request):
 
 @login_required(login_url="login")
 def services_view(request):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    managed_projects = Projects.objects.filter(manager=profile)
-    managed_project_ids = list(managed_projects.values_list("id", flat=True))
+    managed_project_ids = request.access.managed_project_ids
     can_edit = request.user.is_superuser or bool(managed_project_ids)
 
     # Показываем все компании для выбора, проверка прав будет при сохранении
@@ -1026,70 +870,120 @@ def services_view(request):
     return render(request, "services/list.html", context)
 
 
+# Порядок карточек в колонке канбан-доски (индекс status, date_create, id)
+KANBAN_SORT = "-date_create"
+
+
 @login_required(login_url="login")
 def issues_view(request):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
-    issues = (
-        Issues.objects.select_related(
-            "Companies",
-            "Companies__owner",
-            "DataBases",
-            "Services",
-            "Services__company",
-            "users",
-            "applicant_content_type",
-            "supervisor",
-        ).order_by("-date_create")
-    )
-
+    issues, selected_project_id = _filtered_issues(request)
     all_projects = Projects.objects.all().order_by("name")
-    selected_project_id = request.GET.get("project")
-    if selected_project_id:
-        try:
-            selected_project_id = int(selected_project_id)
-            issues = issues.filter(
-                Q(Companies__owner_id=selected_project_id)
-                | Q(DataBases__owner_id=selected_project_id)
-                | Q(Services__company__owner_id=selected_project_id)
-            )
-        except (ValueError, TypeError):
-            selected_project_id = None
 
     # Определяем режим отображения (table или kanban)
     view_mode = request.GET.get("view", "table")
     if view_mode not in ["table", "kanban"]:
         view_mode = "table"
-    
-    # Группируем заявки по статусам для канбан-доски
+
+    sort = parse_sort(request.GET.get("sort"))
+    next_cursor = None
+    # Канбан-доска: счетчики колонок одним GROUP BY, в каждой колонке только первые карточки
     issues_by_status = []
+    kanban_total = 0
     if view_mode == "kanban":
+        counts = dict(issues.order_by().values_list("status").annotate(count=Count("id")))
+        kanban_total = sum(counts.values())
         for status_code, status_label in Issues.STATUS_CHOICES:
-            status_issues = [issue for issue in issues if issue.status == status_code]
+            count = counts.get(status_code, 0)
+            page = None
+            if count:
+                page = keyset_paginate(
+                    issues.filter(status=status_code), KANBAN_SORT, None, settings.KANBAN_COLUMN_PAGE_SIZE
+                )
             issues_by_status.append({
                 "code": status_code,
                 "label": status_label,
-                "issues": status_issues,
-                "count": len(status_issues)
+                "issues": page.items if page else [],
+                "count": count,
+                "next_cursor": page.next_cursor if page else None,
             })
-    
+    else:
+        # Таблица показывает первую страницу, следующие подгружаются через issues_page_view
+        try:
+            page = keyset_paginate(issues, sort, request.GET.get("cursor"), settings.ISSUES_PAGE_SIZE)
+        except InvalidCursor:
+            page = keyset_paginate(issues, sort, None, settings.ISSUES_PAGE_SIZE)
+        issues = page.items
+        next_cursor = page.next_cursor
+
     context = {
         "issues": issues,
         "all_projects": all_projects,
         "selected_project_id": selected_project_id,
         "view_mode": view_mode,
         "issues_by_status": issues_by_status,
+        "kanban_total": kanban_total,
         "status_choices": Issues.STATUS_CHOICES,
+        "sort": sort,
+        "next_cursor": next_cursor,
     }
     return render(request, "issues/list.html", context)
 
 
+@login_required(login_url="login")
+def issues_page_view(request):
+    """Следующая страница таблицы заявок после курсора: HTML строк и курсор следующей страницы"""
+    issues, _ = _filtered_issues(request)
+    sort = parse_sort(request.GET.get("sort"))
+    try:
+        page = keyset_paginate(issues, sort, request.GET.get("cursor"), settings.ISSUES_PAGE_SIZE)
+    except InvalidCursor as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+    html = render_to_string("issues/table_rows.html", {"issues": page.items}, request=request)
+    return JsonResponse({"success": True, "html": html, "next_cursor": page.next_cursor})
+
+
+@login_required(login_url="login")
+def issues_kanban_column_view(request):
+    """Следующие карточки колонки канбан-доски (status) после курсора"""
+    status = request.GET.get("status")
+    if status not in dict(Issues.STATUS_CHOICES):
+        return JsonResponse({"success": False, "error": "Недопустимый статус"}, status=400)
+    issues, _ = _filtered_issues(request)
+    try:
+        page = keyset_paginate(
+            issues.filter(status=status), KANBAN_SORT, request.GET.get("cursor"), settings.KANBAN_COLUMN_PAGE_SIZE
+        )
+    except InvalidCursor as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+    html = render_to_string(
+        "issues/kanban_cards.html", {"issues": page.items, "status_code": status}, request=request
+    )
+    return JsonResponse({"success": True, "html": html, "next_cursor": page.next_cursor})
+
+
+def _filtered_issues(request):
+    """Заявки со связанными объектами для списка и выбранный в фильтре проект"""
+    issues = Issues.objects.select_related(
+        "Companies",
+        "Companies__owner",
+        "DataBases",
+        "Services",
+        "Services__company",
+        "users",
+        "applicant_content_type",
+        "supervisor",
+    ).order_by("-date_create")
+
+    selected_project_id = request.GET.get("project")
+    if selected_project_id:
+        try:
+            selected_project_id = int(selected_project_id)
+            issues = issues.filter(project_id=selected_project_id)
+        except (ValueError, TypeError):
+            selected_project_id = None
+    return issues, selected_project_id
+
+
 @login_required(login_url="login")
 def issue_create_view(request):
     return _issue_form_view(request)
@@ -1102,14 +996,7 @@ def issue_detail_view(request, pk):
 
 
 def _issue_form_view(request, issue=None):
-    profile, _ = Users.objects.get_or_create(
-        auth_user=request.user,
-        defaults={
-            "name": request.user.username,
-            "email": request.user.email,
-            "role": "user",
-        },
-    )
+    profile = request.profile
     parent_queryset = Issues.objects.exclude(pk=issue.pk) if issue else Issues.objects.all()
 
     if request.method == "POST":
@@ -1120,24 +1007,19 @@ def _issue_form_view(request, issue=None):
             
             comment_text = form.cleaned_data.get("comment", "").strip()
             
-            # Если будет создан комментарий, устанавливаем флаг ДО сохранения заявки
-            if comment_text and issue:
-                issue._creating_comment_with_update = True
-            
-            issue = form.save()
-            new_status = issue.status
-            
-            # Если статус изменился, комментарий обязателен (проверка уже в форме)
-            # Создаем комментарий, если он указан
-            if comment_text:
-                # Для новых заявок устанавливаем флаг после создания
-                if not hasattr(issue, '_creating_comment_with_update'):
-                    issue._creating_comment_with_update = True
-                IssueComments.objects.create(
-                    issue=issue,
-                    user=profile,
-                    comment=comment_text,
-                )
+            # Заявка, комментарий и их события в outbox сохраняются одной транзакцией
+            with transaction.atomic():
+                issue = form.save()
+                new_status = issue.status
+                
+                # Если статус изменился, комментарий обязателен (проверка уже в форме)
+                # Создаем комментарий, если он указан
+                if comment_text:
+                    IssueComments.objects.create(
+                        issue=issue,
+                        user=profile,
+                        comment=comment_text,
+                    )
             
             # Если статус изменился, но комментарий не был указан (не должно произойти из-за валидации)
             if old_status and new_status != old_status and not comment_text:
@@ -1162,16 +1044,9 @@ def issue_update_status_view(request, pk):
     """AJAX endpoint для обновления статуса заявки через drag and drop"""
     try:
         issue = get_object_or_404(Issues, pk=pk)
-        profile, _ = Users.objects.get_or_create(
-            auth_user=request.user,
-            defaults={
-                "name": request.user.username,
-                "email": request.user.email,
-                "role": "user",
-            },
-        )
+        profile = request.profile
         
-        data = json.loads(request.body)
+        data = json_codec.loads(request.body)
         new_status = data.get("status")
         comment_text = data.get("comment", "").strip()
         
@@ -1193,31 +1068,32 @@ def issue_update_status_view(request, pk):
         if not comment_text:
             return JsonResponse({"success": False, "error": "Комментарий обязателен при изменении статуса"}, status=400)
         
-        # Обновляем статус
-        issue.status = new_status
-        # Устанавливаем флаг ДО сохранения, чтобы issue_post_save отложил отправку
-        issue._creating_comment_with_update = True
-        issue.save()
-        
-        # Создаем комментарий с указанным текстом
-        try:
-            status_labels = dict(Issues.STATUS_CHOICES)
-            old_label = status_labels.get(old_status, old_status)
-            new_label = status_labels.get(new_status, new_status)
-            
-            # Формируем полный текст комментария
-            full_comment = f"Статус изменен с '{old_label}' на '{new_label}' через канбан-доску.\n{comment_text}"
+        with transaction.atomic():
+            # Обновляем статус
+            issue.status = new_status
+            issue.save()
             
-            IssueComments.objects.create(
-                issue=issue,
-                user=profile,
-                comment=full_comment,
-            )
-        except Exception as comment_error:
-            # Если не удалось создать комментарий, это не критично - статус уже обновлен
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.warning(f"Не удалось создать комментарий для заявки {issue.pk}: {comment_error}")
+            # Создаем комментарий с указанным текстом
+            try:
+                status_labels = dict(Issues.STATUS_CHOICES)
+                old_label = status_labels.get(old_status, old_status)
+                new_label = status_labels.get(new_status, new_status)
+                
+                # Формируем полный текст комментария
+                full_comment = f"Статус изменен с '{old_label}' на '{new_label}' через канбан-доску.\n{comment_text}"
+                
+                # Savepoint: ошибка комментария не должна откатывать уже обновленный статус
+                with transaction.atomic():
+                    IssueComments.objects.create(
+                        issue=issue,
+                        user=profile,
+                        comment=full_comment,
+                    )
+            except Exception as comment_error:
+                # Если не удалось создать комментарий, это не критично - статус уже обновлен
+                import logging
+                logger = logging.getLogger(__name__)
+                logger.warning(f"Не удалось создать комментарий для заявки {issue.pk}: {comment_error}")
         
         return JsonResponse({"success": True})
         
@@ -1230,3 +1106,18 @@ def issue_update_status_view(request, pk):
         return JsonResponse({"success": False, "error": "Внутренняя ошибка сервера: " + str(e)}, status=500)
 
 
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """
+    Метрики веб-процесса в формате Prometheus (задержки producer-а).
+
+    Запрос попадает в один из рабочих процессов веб-сервера, и ответ содержит
+    только его метрики; consumer и relay отдают свои через --metrics-port.
+    Доступ - с заголовком "Authorization: Bearer <METRICS_AUTH_TOKEN>" или
+    сотрудникам (is_staff).
+    """
+    token = settings.METRICS_AUTH_TOKEN
+    has_token = bool(token) and constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}")
+    if not has_token and not request.user.is_staff:
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
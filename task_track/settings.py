@@ -48,6 +48,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'erp_tools.middleware.ProfileMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "debug_toolbar.middleware.DebugToolbarMiddleware"
@@ -91,6 +92,37 @@ DATABASES = {
 
 
 
+# Cache
+# Общий кэш (Redis) нужен, чтобы сброс кэшей по сигналам был виден всем процессам
+REDIS_URL = config('REDIS_URL', default='')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': REDIS_URL,
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Время жизни кэша профиля и прав пользователя (request.profile), секунды.
+# Профиль кэшируется только в общем кэше (Redis): LocMemCache у каждого процесса свой
+PROFILE_CACHE_TTL = config('PROFILE_CACHE_TTL', default=300, cast=int)
+
+# Размер страницы таблицы заявок (keyset-пагинация, следующие страницы подгружаются по курсору)
+ISSUES_PAGE_SIZE = config('ISSUES_PAGE_SIZE', default=50, cast=int)
+# Карточек в колонке канбан-доски при открытии и за одну подгрузку
+KANBAN_COLUMN_PAGE_SIZE = config('KANBAN_COLUMN_PAGE_SIZE', default=20, cast=int)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -142,6 +174,68 @@ KAFKA_BOOTSTRAP_SERVERS = config('KAFKA_BOOTSTRAP_SERVERS', default='localhost:9
 KAFKA_ISSUES_TOPIC = config('KAFKA_ISSUES_TOPIC', default='issues-events')
 KAFKA_ISSUES_1C_TOPIC = config('KAFKA_ISSUES_1C_TOPIC', default='issues-events-1c')
 KAFKA_CONSUMER_GROUP = config('KAFKA_CONSUMER_GROUP', default='django-task-track')
+# Сжимаемый (cleanup.policy=compact) топик текущего состояния заявок, ключ - id заявки; пусто - не публиковать
+KAFKA_ISSUES_STATE_TOPIC = config('KAFKA_ISSUES_STATE_TOPIC', default='')
+
+# Consumer событий 1С: отдельный пул процессов (run_kafka_consumer) или поток в веб-процессе
+KAFKA_CONSUMER_WORKERS = config('KAFKA_CONSUMER_WORKERS', default=1, cast=int)
+KAFKA_CONSUMER_IN_WEB_PROCESS = config('KAFKA_CONSUMER_IN_WEB_PROCESS', default=False, cast=bool)
+# Подписка consumer-а на собственный топик KAFKA_ISSUES_TOPIC (свои сообщения отбрасываются по заголовку)
+KAFKA_CONSUMER_SUBSCRIBE_OWN_TOPIC = config('KAFKA_CONSUMER_SUBSCRIBE_OWN_TOPIC', default=False, cast=bool)
+# Пакетная обработка message_pack из consumer.poll (bulk_create/bulk_update)
+KAFKA_CONSUMER_BATCH_MODE = config('KAFKA_CONSUMER_BATCH_MODE', default=True, cast=bool)
+# Потоки обработки внутри consumer-а: сообщения одной заявки - в одном потоке, разных - параллельно (1 - без потоков)
+KAFKA_CONSUMER_THREADS = config('KAFKA_CONSUMER_THREADS', default=1, cast=int)
+KAFKA_CONSUMER_QUEUE_SIZE = config('KAFKA_CONSUMER_QUEUE_SIZE', default=1000, cast=int)
+KAFKA_CONSUMER_WORKER_BATCH_SIZE = config('KAFKA_CONSUMER_WORKER_BATCH_SIZE', default=200, cast=int)
+# Сообщения 1С с ошибкой повторяются с экспоненциальной задержкой (BASE_DELAY * 2^n, не больше MAX_DELAY, секунды);
+# после RETRY_ATTEMPTS повторов, а также нечитаемые и некорректные сообщения уходят в DLQ-топик
+KAFKA_ISSUES_1C_DLQ_TOPIC = config('KAFKA_ISSUES_1C_DLQ_TOPIC', default='issues-events-1c-dlq')
+KAFKA_CONSUMER_RETRY_ATTEMPTS = config('KAFKA_CONSUMER_RETRY_ATTEMPTS', default=5, cast=int)
+KAFKA_CONSUMER_RETRY_BASE_DELAY = config('KAFKA_CONSUMER_RETRY_BASE_DELAY', default=1.0, cast=float)
+KAFKA_CONSUMER_RETRY_MAX_DELAY = config('KAFKA_CONSUMER_RETRY_MAX_DELAY', default=60.0, cast=float)
+# Offset фиксируется после транзакции; повторы отсекаются по таблице ProcessedMessages
+KAFKA_CONSUMER_OFFSET_RESET = config('KAFKA_CONSUMER_OFFSET_RESET', default='earliest')
+KAFKA_PROCESSED_MESSAGES_RETENTION_HOURS = config('KAFKA_PROCESSED_MESSAGES_RETENTION_HOURS', default=168, cast=int)
+KAFKA_PROCESSED_MESSAGES_PRUNE_INTERVAL = config('KAFKA_PROCESSED_MESSAGES_PRUNE_INTERVAL', default=3600, cast=int)
+# Период обновления метрик consumer-а (отставание партиций, скорость), секунды
+KAFKA_CONSUMER_METRICS_INTERVAL = config('KAFKA_CONSUMER_METRICS_INTERVAL', default=10, cast=int)
+# Кэш справочников consumer-а (Companies, Services, DataBases, Users)
+KAFKA_REFERENCE_CACHE_SIZE = config('KAFKA_REFERENCE_CACHE_SIZE', default=10000, cast=int)
+KAFKA_REFERENCE_CACHE_TTL = config('KAFKA_REFERENCE_CACHE_TTL', default=300, cast=float)
+
+# JSON-кодек сообщений Kafka и JSON-ответов: 'auto' (orjson, если установлен), 'orjson' или 'json'
+JSON_CODEC = config('JSON_CODEC', default='auto')
+
+# Формат событий обновления заявки: 'full' - полный снимок, 'delta' - только измененные поля
+KAFKA_ISSUE_EVENT_FORMAT = config('KAFKA_ISSUE_EVENT_FORMAT', default='full')
+
+# Transactional outbox: события заявок пишутся в OutboxEvents и доставляются командой relay_issue_events
+KAFKA_OUTBOX_ENABLED = config('KAFKA_OUTBOX_ENABLED', default=True, cast=bool)
+KAFKA_OUTBOX_BATCH_SIZE = config('KAFKA_OUTBOX_BATCH_SIZE', default=500, cast=int)
+KAFKA_OUTBOX_POLL_INTERVAL = config('KAFKA_OUTBOX_POLL_INTERVAL', default=1.0, cast=float)
+KAFKA_OUTBOX_SEND_TIMEOUT = config('KAFKA_OUTBOX_SEND_TIMEOUT', default=30, cast=int)
+# Объединение событий одной заявки в одно сообщение (0 - без объединения)
+KAFKA_OUTBOX_COALESCE_WINDOW_MS = config('KAFKA_OUTBOX_COALESCE_WINDOW_MS', default=2000, cast=int)
+KAFKA_OUTBOX_COALESCE_MAX_DELAY_MS = config('KAFKA_OUTBOX_COALESCE_MAX_DELAY_MS', default=10000, cast=int)
+
+# Предохранитель producer-а: после N ошибок подряд брокер не вызывается RESET_TIMEOUT секунд
+KAFKA_CIRCUIT_FAILURE_THRESHOLD = config('KAFKA_CIRCUIT_FAILURE_THRESHOLD', default=3, cast=int)
+KAFKA_CIRCUIT_RESET_TIMEOUT = config('KAFKA_CIRCUIT_RESET_TIMEOUT', default=30, cast=float)
+KAFKA_PRODUCER_MAX_BLOCK_MS = config('KAFKA_PRODUCER_MAX_BLOCK_MS', default=5000, cast=int)
+# Профиль producer-а: 'throughput' - пакетирование, сжатие и идемпотентная конвейерная отправка,
+# 'reliable' - по одному сообщению в полете без пакетирования
+KAFKA_PRODUCER_PROFILE = config('KAFKA_PRODUCER_PROFILE', default='throughput')
+KAFKA_PRODUCER_LINGER_MS = config('KAFKA_PRODUCER_LINGER_MS', default=20, cast=int)
+KAFKA_PRODUCER_BATCH_SIZE = config('KAFKA_PRODUCER_BATCH_SIZE', default=256 * 1024, cast=int)
+# lz4, zstd, snappy, gzip или none; без установленного кодека используется gzip
+KAFKA_PRODUCER_COMPRESSION = config('KAFKA_PRODUCER_COMPRESSION', default='lz4')
+KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS = config('KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS', default=120000, cast=int)
+# Локальный буфер прямой отправки (KAFKA_OUTBOX_ENABLED=False) на время недоступности брокера
+KAFKA_SPOOL_DIR = config('KAFKA_SPOOL_DIR', default=str(BASE_DIR / 'var' / 'kafka_spool'))
+KAFKA_SPOOL_SEGMENT_BYTES = config('KAFKA_SPOOL_SEGMENT_BYTES', default=16 * 1024 * 1024, cast=int)
+KAFKA_SPOOL_FSYNC_EVERY = config('KAFKA_SPOOL_FSYNC_EVERY', default=100, cast=int)
+KAFKA_SPOOL_FSYNC_INTERVAL = config('KAFKA_SPOOL_FSYNC_INTERVAL', default=1.0, cast=float)
 
 
 # Логирование для Kafka
@@ -170,4 +264,9 @@ LOGGING = {
             'level': 'INFO',
         },
     },
-}
\ No newline at end of file
+}
+
+# Метрики Prometheus: /metrics/ в веб-процессе (только метрики обслужившего запрос
+# рабочего процесса), --metrics-port у команд Kafka. /metrics/ доступен с заголовком
+# "Authorization: Bearer <токен>" или сотрудникам (is_staff)
+METRICS_AUTH_TOKEN = config('METRICS_AUTH_TOKEN', default='')
@@ -37,10 +37,13 @@ from erp_tools.views import (
     service_desk_databases_view,
     services_view,
     issues_view,
+    issues_page_view,
+    issues_kanban_column_view,
     company_client_teams_view,
     issue_detail_view,
     issue_create_view,
     issue_update_status_view,
+    metrics_view,
     user_delete_view,
     user_update_view,
     users_view,
@@ -68,10 +71,13 @@ urlpatterns = [
     path('databases/', service_desk_databases_view, name='databases'),
     path('services/', services_view, name='services'),
     path('issues/', issues_view, name='issues'),
+    path('issues/page/', issues_page_view, name='issues-page'),
+    path('issues/kanban/column/', issues_kanban_column_view, name='issues-kanban-column'),
     path('issues/create/', issue_create_view, name='issue-create'),
     path('issues/<int:pk>/', issue_detail_view, name='issue-detail'),
     path('companies/<int:company_pk>/client-teams/', company_client_teams_view, name='company-client-teams'),
     path('issues/<int:pk>/update-status/', issue_update_status_view, name='issue-update-status'),
+    path('metrics/', metrics_view, name='metrics'),
 ]
 
 if settings.DEBUG: